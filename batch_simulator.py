@@ -0,0 +1,149 @@
+# 多数の (盤面, 操作) を NumPy でまとめてシミュレーションする（solver.py の simulate と同じ結果）
+import numpy as np
+
+from solver import BOARD_SIZE, BOARD_CELLS, MAX_CELL_VALUE, check_max_value
+
+# simulate_many が一度に NumPy 配列にする件数（メモリ使用量の上限）
+BATCH_CHUNK = 20000
+# 空セル・クラスタなしを表すラベル（セル番号 0〜BOARD_CELLS-1 と重ならない値）
+NO_LABEL = BOARD_CELLS
+CELL_INDEX = np.arange(BOARD_CELLS).reshape(BOARD_SIZE, BOARD_SIZE)
+# 合成先（最も下の行、その中で最も左の列）ほど大きくなるキー
+TARGET_KEY = (CELL_INDEX // BOARD_SIZE) * BOARD_SIZE + (BOARD_SIZE - 1 - CELL_INDEX % BOARD_SIZE)
+
+def apply_gravity_batch(boards):
+    """(N, BOARD_SIZE, BOARD_SIZE) の盤面それぞれで、各列の数字を下に落下させた配列を返す"""
+    order = np.argsort(boards != 0, axis=1, kind="stable")
+    return np.take_along_axis(boards, order, axis=1)
+
+def label_clusters_batch(boards):
+    """
+    隣接する同じ数字の連結成分にラベルを付ける。
+    ラベルは成分内で行優先に最初のセル番号（空セルは NO_LABEL）。
+    find_clusters がクラスタを返す順序は、このラベルの昇順と一致する。
+    """
+    labels = np.where(boards > 0, CELL_INDEX, NO_LABEL)
+    same_v = (boards[:, 1:, :] == boards[:, :-1, :]) & (boards[:, 1:, :] > 0)
+    same_h = (boards[:, :, 1:] == boards[:, :, :-1]) & (boards[:, :, 1:] > 0)
+    while True:
+        new = labels.copy()
+        pair = np.minimum(labels[:, 1:, :], labels[:, :-1, :])
+        new[:, 1:, :] = np.where(same_v, np.minimum(new[:, 1:, :], pair), new[:, 1:, :])
+        new[:, :-1, :] = np.where(same_v, np.minimum(new[:, :-1, :], pair), new[:, :-1, :])
+        pair = np.minimum(new[:, :, 1:], new[:, :, :-1])
+        new[:, :, 1:] = np.where(same_h, np.minimum(new[:, :, 1:], pair), new[:, :, 1:])
+        new[:, :, :-1] = np.where(same_h, np.minimum(new[:, :, :-1], pair), new[:, :, :-1])
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+def merge_clusters_batch(boards, add_cells, max_value):
+    """
+    各盤面で3個以上のクラスタを一斉に合成し、(合成後の盤面, 合成セル数, クラスタがあったか) を返す。
+    add_cells は (N,) のセル番号。0以上の盤面は "add" の1回目の合成として、すべてのクラスタの
+    合成先をそのセルにする（merge_clusters がクラスタ順に上書きするのと同じ結果にする）。
+    それ以外（-1）は各クラスタの最も下の行・最も左の列のセルを合成先にする。
+    """
+    n = len(boards)
+    labels = label_clusters_batch(boards)
+    flat_labels = labels.reshape(n, BOARD_CELLS)
+    flat = boards.reshape(n, BOARD_CELLS)
+    # 成分 ID = 盤面番号 * (BOARD_CELLS + 1) + ラベル
+    comp = np.arange(n)[:, None] * (BOARD_CELLS + 1) + flat_labels
+    sizes = np.bincount(comp.ravel(), minlength=n * (BOARD_CELLS + 1))
+    in_cluster = (flat_labels != NO_LABEL) & (sizes[comp] >= 3)
+    merged = in_cluster.sum(axis=1)
+    has_cluster = merged > 0
+
+    # クラスタごとの値・サイズ・合成先
+    cluster_ids = np.unique(comp[in_cluster])
+    cluster_board = cluster_ids // (BOARD_CELLS + 1)
+    cluster_label = cluster_ids % (BOARD_CELLS + 1)
+    new_values = flat[cluster_board, cluster_label].astype(np.int32) + sizes[cluster_ids] - 2
+    placed = new_values < max_value
+    target_key = np.full(n * (BOARD_CELLS + 1), -1)
+    np.maximum.at(target_key, comp[in_cluster], np.broadcast_to(TARGET_KEY.ravel(), (n, BOARD_CELLS))[in_cluster])
+    keys = target_key[cluster_ids]
+    targets = (keys // BOARD_SIZE) * BOARD_SIZE + (BOARD_SIZE - 1 - keys % BOARD_SIZE)
+
+    result = np.where(in_cluster, 0, flat)
+    use_add = add_cells[cluster_board] >= 0
+    normal = placed & ~use_add
+    result[cluster_board[normal], targets[normal]] = new_values[normal]
+
+    # "add" の1回目: 合成先セルの値は、そのセルを含むか値を置く最後のクラスタで決まる
+    if use_add.any():
+        action_cells = add_cells[cluster_board].clip(min=0)
+        contains = flat_labels[cluster_board, action_cells] == cluster_label
+        # 先頭セルが合成先セルのクラスタは、merge_clusters と同様に、それより前のクラスタが
+        # 置いた値を基準値にする（同じ盤面で直前に値を置いたクラスタを探す）
+        placed_index = np.where(use_add & placed, np.arange(len(cluster_ids)), -1)
+        previous = np.maximum.accumulate(np.concatenate(([-1], placed_index[:-1])))
+        inherit = (use_add & (cluster_label == action_cells) & (previous >= 0)
+                   & (cluster_board[previous.clip(min=0)] == cluster_board))
+        new_values[inherit] = new_values[previous[inherit]] + sizes[cluster_ids[inherit]] - 2
+        placed = new_values < max_value
+        touches = use_add & (placed | contains)
+        last = np.full(n, -1)
+        np.maximum.at(last, cluster_board[touches], np.flatnonzero(touches))
+        hit = np.flatnonzero(last >= 0)
+        chosen = last[hit]
+        result[hit, add_cells[hit]] = np.where(placed[chosen], new_values[chosen], 0)
+    return result.reshape(boards.shape).astype(boards.dtype), merged, has_cluster
+
+def simulate_batch(board, actions, max_value=20):
+    """
+    pack_board 形式の盤面 board に actions の各操作を適用し、連鎖が止まるまで一括でシミュレーションする。
+    戻り値: (落下回数 (N,), 合成セル数 (N,), 最終盤面 (N, BOARD_SIZE, BOARD_SIZE))。
+    """
+    return simulate_pairs([board] * len(actions), actions, max_value)
+
+def simulate_pairs(boards, actions, max_value=20):
+    """
+    simulate_batch の一般形。boards[k]（pack_board 形式）に actions[k] を適用した結果を一括で求める。
+    盤面の値は int8 に収まる場合は int8、そうでなければ int16 で扱う。
+    solver の simulate と同じく、MAX_CELL_VALUE を超える値の盤面と範囲外の max_value は ValueError にする
+    （範囲内なら結果の値は 1バイトに収まり、最終盤面を uint8 にしても値は変わらない）。
+    """
+    check_max_value(max_value)
+    n = len(actions)
+    raw = np.frombuffer(b"".join(boards), dtype=np.uint8).reshape(n, BOARD_SIZE, BOARD_SIZE)
+    if n and raw.max() > MAX_CELL_VALUE:
+        raise ValueError(f"セルの値は 0〜{MAX_CELL_VALUE} で入力してください（{raw.max()}）")
+    dtype = np.int8 if (not n or raw.max() < 127) and max_value <= 127 else np.int16
+    boards = raw.astype(dtype)
+    is_add = np.array([op == "add" for op, _, _ in actions], dtype=bool)
+    rows = np.array([r for _, r, _ in actions], dtype=np.intp)
+    cols = np.array([c for _, _, c in actions], dtype=np.intp)
+    index = np.arange(n)
+    current = boards[index, rows, cols]
+    boards[index, rows, cols] = np.where(is_add, np.where(current > 0, current + 1, 0), 0)
+    boards = apply_gravity_batch(boards)
+
+    falls = np.zeros(n, dtype=np.int32)
+    merged = np.zeros(n, dtype=np.int32)
+    add_cells = np.where(is_add, rows * BOARD_SIZE + cols, -1)
+    active = index
+    while len(active):
+        result, merged_now, has_cluster = merge_clusters_batch(boards[active], add_cells[active], max_value)
+        active = active[has_cluster]
+        if not len(active):
+            break
+        boards[active] = apply_gravity_batch(result[has_cluster])
+        merged[active] += merged_now[has_cluster]
+        falls[active] += 1
+        add_cells[active] = -1
+    return falls, merged, boards
+
+def simulate_many(boards, actions, max_value=20, chunk_size=BATCH_CHUNK):
+    """
+    simulate_pairs を chunk_size 件ずつ実行し、simulate(suppress_output=True) と同じ
+    (落下回数, 合成セル数, 最終盤面 (bytes)) のタプルのリストを返す。
+    """
+    results = []
+    for start in range(0, len(actions), chunk_size):
+        falls, merged, after = simulate_pairs(boards[start:start + chunk_size],
+                                              actions[start:start + chunk_size], max_value)
+        packed = after.astype(np.uint8).reshape(len(after), BOARD_CELLS)
+        results.extend(zip(falls.tolist(), merged.tolist(), (row.tobytes() for row in packed)))
+    return results
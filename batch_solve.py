@@ -0,0 +1,183 @@
+# 盤面をまとめて解くコマンドライン版（Streamlit を使わない）
+#   python batch_solve.py boards.txt > results.jsonl
+#   python batch_solve.py boards.jsonl --depth 3 --workers 4 -o results.jsonl
+#   python batch_solve.py boards.jsonl --depth 4 --time-limit 0.5   # 1盤面あたり 0.5 秒で打ち切る
+#   python batch_solve.py boards.jsonl --store solved_boards.sqlite3 # 解いた結果を保存し、次回から再利用する
+# 入力は main.py と同じ 5行のカンマ区切り（盤面の間の空行・# で始まる行は無視）か、
+# 1行に1盤面の JSONL（{"id": ..., "board": [[...], ...]} または盤面の配列そのもの）。
+# 結果は入力の順に1行ずつ JSONL で書き出し、処理速度（盤面/秒）を標準エラーに表示する。
+import argparse
+import itertools
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from result_store import ResultStore
+from solver import (BOARD_SIZE, DEFAULT_MAX_VALUE, MAX_SEARCH_DEPTH, SEARCH_WORKERS, MergeGameSimulator,
+                    check_max_value, pack_board)
+
+# 一度にワーカーへ渡す盤面数（ワーカー数 × BATCH_WINDOW 件ずつ読み込むので、入力全体は保持しない）
+BATCH_WINDOW = 64
+# --store で開いた ResultStore（パスごとに、各ワーカープロセスで1つ）
+_stores = {}
+
+def parse_csv_boards(lines):
+    """
+    5行のカンマ区切りの盤面を順に読み、(id, 盤面 or None, エラー or None) を返すジェネレータ。
+    id は入力の何番目の盤面か（0始まり）。
+    """
+    rows = []
+    index = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        rows.append(line)
+        if len(rows) < BOARD_SIZE:
+            continue
+        try:
+            board = [[int(v.strip()) for v in row.split(",")] for row in rows]
+            if any(len(values) != BOARD_SIZE for values in board):
+                raise ValueError(f"各行に{BOARD_SIZE}つの数値が必要です。")
+            pack_board(board)  # 値の範囲を確かめる
+            yield index, board, None
+        except ValueError as e:
+            yield index, None, f"入力解析エラー: {e}"
+        rows = []
+        index += 1
+    if rows:
+        yield index, None, f"{BOARD_SIZE}行入力してください。"
+
+def parse_jsonl_boards(lines):
+    """
+    JSONL の盤面を順に読み、parse_csv_boards と同じ形式で返すジェネレータ
+    （id は指定があればそれを使う。解析に失敗した行も、id が読めればその id でエラーを返す）。
+    """
+    index = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        board_id = index
+        try:
+            record = json.loads(line)
+            if isinstance(record, dict):
+                board_id = record.get("id", index)
+                board = record["board"]
+            else:
+                board = record
+            if len(board) != BOARD_SIZE or any(len(row) != BOARD_SIZE for row in board):
+                raise ValueError(f"{BOARD_SIZE}x{BOARD_SIZE} の盤面が必要です。")
+            board = [[int(v or 0) for v in row] for row in board]
+            pack_board(board)  # 値の範囲を確かめる
+            yield board_id, board, None
+        except (ValueError, KeyError, TypeError) as e:
+            yield board_id, None, f"入力解析エラー: {e}"
+        index += 1
+
+def read_boards(stream, input_format="auto"):
+    """stream から盤面を読むジェネレータ。input_format が "auto" の場合は最初の行で判定する。"""
+    if input_format == "auto":
+        first = ""
+        for first in stream:
+            if first.strip():
+                break
+        input_format = "jsonl" if first.lstrip().startswith(("{", "[")) else "csv"
+        stream = itertools.chain([first], stream)
+    return parse_jsonl_boards(stream) if input_format == "jsonl" else parse_csv_boards(stream)
+
+def describe(candidate):
+    """evaluate_candidates の候補を JSON 用の辞書にする"""
+    return {'action': list(candidate['action']), 'fall': candidate['fall'], 'merged': candidate['merged']}
+
+def get_store(path):
+    """path の ResultStore を返す（path が None なら None）"""
+    if path is None:
+        return None
+    if path not in _stores:
+        _stores[path] = ResultStore(path)
+    return _stores[path]
+
+def solve_board(task):
+    """
+    1盤面を解く（ワーカープロセスで実行する）。
+    task = (id, 盤面, エラー, max_value, depth, 時間上限, 局面数上限, 結果の保存先)。
+    1手の落下回数優先・合成セル数優先の操作と、depth 手までの find_best_action_multistep の結果を辞書で返す
+    （時間上限・局面数上限がある場合は search_deepening で、上限内の最良手順を返す）。
+    保存先（ResultStore のパス）があれば、保存済みの手順を使い、最後まで探索した手順を保存する。
+    """
+    board_id, board, error, max_value, depth, time_limit, node_limit, store_path = task
+    if error is not None:
+        return {'id': board_id, 'error': error}
+    try:
+        simulator = MergeGameSimulator(board)
+        candidates = simulator.evaluate_candidates(max_value=max_value)
+    except ValueError as e:
+        return {'id': board_id, 'error': f"入力解析エラー: {e}"}
+    if not candidates:
+        return {'id': board_id, 'error': "盤面に数字がありません。"}
+    best = simulator.find_best_action_multistep(max_value, candidates=candidates, max_depth=depth,
+                                                time_limit=time_limit, node_limit=node_limit,
+                                                store=get_store(store_path))['sequence']
+    return {
+        'id': board_id,
+        'by_fall': describe(simulator.find_best_action_by_fall(max_value, candidates)),
+        'by_merged': describe(simulator.find_best_action(max_value, candidates)),
+        'multistep': {'actions': [list(action) for action in best['actions']], 'merged': best['merged'],
+                      'board': [list(best['board'][r * BOARD_SIZE:(r + 1) * BOARD_SIZE]) for r in range(BOARD_SIZE)],
+                      'nodes': best['nodes'], 'depth': best['depth'], 'complete': best['complete']},
+    }
+
+def solve_stream(tasks, workers=1):
+    """tasks を solve_board で解き、入力の順に結果を返すジェネレータ（workers > 1 ならプロセスで並列化）"""
+    if workers <= 1:
+        yield from map(solve_board, tasks)
+        return
+    window = workers * BATCH_WINDOW
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(itertools.islice(tasks, window))
+            if not batch:
+                break
+            yield from executor.map(solve_board, batch, chunksize=BATCH_WINDOW // 4)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="盤面をまとめて解き、結果を JSONL で出力する")
+    parser.add_argument("input", nargs="?", default="-", help="入力ファイル（省略または - で標準入力）")
+    parser.add_argument("-o", "--output", default="-", help="出力ファイル（省略または - で標準出力）")
+    parser.add_argument("--format", choices=("auto", "csv", "jsonl"), default="auto", help="入力形式")
+    parser.add_argument("--max-value", type=int, default=DEFAULT_MAX_VALUE, help="最大合成値 (max_value)")
+    parser.add_argument("--depth", type=int, default=2, choices=range(1, MAX_SEARCH_DEPTH + 1), help="先読み手数")
+    parser.add_argument("--time-limit", type=float, help="1盤面あたりの先読みの時間上限（秒）")
+    parser.add_argument("--node-limit", type=int, help="1盤面あたりの先読みの局面数の上限")
+    parser.add_argument("--workers", type=int, default=SEARCH_WORKERS, help="並列に解くプロセス数")
+    parser.add_argument("--store", help="解いた結果を保存・再利用する SQLite ファイル（result_store.py）")
+    args = parser.parse_args(argv)
+    try:
+        check_max_value(args.max_value)
+    except ValueError as e:
+        parser.error(str(e))
+
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    sink = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    tasks = ((board_id, board, error, args.max_value, args.depth, args.time_limit, args.node_limit,
+              args.store)
+             for board_id, board, error in read_boards(source, args.format))
+    start = time.perf_counter()
+    count = 0
+    try:
+        for result in solve_stream(tasks, args.workers):
+            sink.write(json.dumps(result, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if sink is not sys.stdout:
+            sink.close()
+    elapsed = time.perf_counter() - start
+    print(f"{count} 盤面 / {elapsed:.2f} 秒 ({count / elapsed if elapsed else 0:.1f} 盤面/秒, "
+          f"workers={args.workers})", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+# solver.py の計測用スクリプト
+#   python benchmark.py                       # 計測結果を表示する
+#   python benchmark.py --json base.json      # 結果を JSON に保存する（コミット間の比較用）
+#   python benchmark.py --compare base.json   # 保存した結果と比べ、遅くなった関数があれば終了コード 1
+#                                             # （計測の揺れが大きいマシンでは、退行とみなす倍率も大きくなる）
+#   python benchmark.py --gravity             # apply_gravity の表引き版とリスト版の比較
+#   python benchmark.py --render              # 盤面の描画（pandas Styler と HTML テンプレート）の比較
+#   python benchmark.py --ocr                 # 数字の認識モデルの fp32・int8・TorchScript の比較（正解率が下がれば終了コード 1）
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from solver import BOARD_SIZE, BOARD_CELLS, NEIGHBORS, MergeGameSimulator, pack_board, unpack_board
+
+# main.py と scan.py のテキスト入力の初期盤面
+DEFAULT_BOARDS = [
+    [[8, 7, 6, 5, 6], [6, 9, 8, 6, 5], [9, 5, 11, 5, 9], [7, 8, 9, 11, 8], [7, 11, 8, 6, 7]],
+    [[5, 5, 4, 5, 5], [4, 5, 5, 4, 5], [5, 4, 5, 5, 4], [5, 5, 4, 5, 5], [4, 5, 5, 4, 5]],
+]
+# --compare で、score（calibrate で割った p50）がこの倍率を超えて遅くなった関数を退行とみなす。
+# 計測の揺れ（noise）が大きい場合は、倍率に noise を掛けた値を閾値にする
+REGRESSION_RATIO = 1.2
+# run_suite で全関数を計測する回数（各関数の結果は score が最小の回のもの）
+SUITE_ROUNDS = 3
+
+class ListGravitySimulator(MergeGameSimulator):
+    """比較用: 列ごとに Python のリストを作って詰め直す、以前の apply_gravity と全列の落下"""
+
+    def apply_gravity(self, board, columns=range(BOARD_SIZE)):
+        for c in range(BOARD_SIZE):
+            column = [board[i] for i in range(c, BOARD_CELLS, BOARD_SIZE) if board[i]]
+            for i in range(BOARD_CELLS - BOARD_SIZE + c, -1, -BOARD_SIZE):
+                board[i] = column.pop() if column else 0
+
+def random_boards(count, seed=0, empty_rate=0.15):
+    """空きを含むランダムな盤面 (bytes) を count 個返す"""
+    rng = random.Random(seed)
+    return [bytes(0 if rng.random() < empty_rate else rng.randint(3, 9) for _ in range(BOARD_CELLS))
+            for _ in range(count)]
+
+def realistic_boards(count, seed=0):
+    """実際の盤面に近い、近い値（幅 4〜6）が並ぶ空きのない盤面 (bytes) を count 個返す"""
+    rng = random.Random(seed)
+    boards = []
+    for _ in range(count):
+        low = rng.randint(3, 8)
+        high = low + rng.randint(3, 5)
+        boards.append(bytes(rng.randint(low, high) for _ in range(BOARD_CELLS)))
+    return boards
+
+def long_chain_boards(count, seed=0, min_fall=3):
+    """1手で min_fall 回以上の連鎖が起きる盤面 (bytes) を、値の幅が狭い乱数盤面から count 個選んで返す"""
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        low = rng.randint(3, 8)
+        board = bytes(rng.randint(low, low + 2) for _ in range(BOARD_CELLS))
+        simulator = MergeGameSimulator(board)
+        if max(simulator._simulate_chain(action, 20, True, True)[0]
+               for action in simulator.candidate_actions()) >= min_fall:
+            boards.append(board)
+    return boards
+
+def benchmark_boards(count, seed=0):
+    """計測に使う盤面: 初期盤面 + 実際に近い盤面 + 長い連鎖の盤面（count は後の2種類それぞれの数）"""
+    return ([pack_board(board) for board in DEFAULT_BOARDS]
+            + realistic_boards(count, seed) + long_chain_boards(count, seed + 1))
+
+def best_of(func, repeat=5):
+    """func を repeat 回実行し、最短の実行時間（秒）を返す"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def calibrate(count=300, seed=0):
+    """
+    このマシンの現在の速さの目安（秒）。solver を使わない純 Python の処理（bytes をキーにした辞書・
+    bytearray の書き換え・リストの幅優先探索）を best_of で計測する。同じマシンでも他のプロセスの負荷で
+    全体が 2倍近く遅くなる時間帯があるため、run_suite はこの時間で割った値（score）を比べる。
+    """
+    rng = random.Random(seed)
+    boards = [bytes(rng.randint(1, 4) for _ in range(BOARD_CELLS)) for _ in range(count)]
+    def run():
+        seen = {}
+        for board in boards:
+            work = bytearray(board)
+            for start in range(BOARD_CELLS):
+                queue, k = [start], 0
+                while k < len(queue):
+                    for j in NEIGHBORS[queue[k]]:
+                        if work[j] == board[start] and j not in queue:
+                            queue.append(j)
+                    k += 1
+                work[start] = len(queue) % 5
+            seen[bytes(work)] = seen.get(bytes(work), 0) + 1
+        return seen
+    return best_of(run, repeat=3)
+
+def percentile(samples, p):
+    """samples（昇順）の p パーセンタイル（最近傍）"""
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def count_simulations(call):
+    """call() を実行し、その中で連鎖を計算した回数（_simulate_chain の実行回数。simulate のキャッシュヒットは数えない）を返す"""
+    original = MergeGameSimulator._simulate_chain
+    count = 0
+
+    def counting(self, *args, **kwargs):
+        nonlocal count
+        count += 1
+        return original(self, *args, **kwargs)
+    MergeGameSimulator._simulate_chain = counting
+    try:
+        call()
+    finally:
+        MergeGameSimulator._simulate_chain = original
+    return count
+
+def measure(name, calls, repeat=5):
+    """
+    calls（引数なしの関数のリスト）を1つずつ計測する。各呼び出しは1回空で実行してから repeat 回実行し、
+    最短の時間をその呼び出しのレイテンシとする（実行ごとに simulate キャッシュを空にする）。
+    レイテンシの p50/p90/p99（ミリ秒）、1秒あたりのシミュレーション数（空の実行で count_simulations で数え、
+    シミュレーションしない関数は None）、tracemalloc で測ったピークメモリ（KiB、別の実行で計測）を辞書で返す。
+    """
+    latencies = []
+    simulations = 0
+    for call in calls:
+        MergeGameSimulator.cache_clear()
+        simulations += count_simulations(call)
+        times = []
+        for _ in range(repeat):
+            MergeGameSimulator.cache_clear()
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+        latencies.append(min(times))
+    latencies.sort()
+    peak = 0
+    tracemalloc.start()
+    for call in calls:
+        MergeGameSimulator.cache_clear()
+        tracemalloc.reset_peak()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    tracemalloc.stop()
+    MergeGameSimulator.cache_clear()
+    total = sum(latencies)
+    return {
+        'name': name,
+        'calls': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'simulations_per_sec': simulations / total if simulations and total else None,
+        'peak_kib': peak / 1024,
+    }
+
+def run_suite(count=20, seed=0, depth=2, rounds=SUITE_ROUNDS):
+    """
+    benchmark_boards の盤面で simulate・find_clusters と各探索関数を計測し、結果のリストを返す。
+    全関数の計測を rounds 回行い、各回の前後の calibrate の平均で p50 を割った値を score とする。
+    各関数の結果は score が最小の回の measure の結果に、'score' と 'noise'（score の最大 / 最小）を加えたもの。
+    """
+    boards = benchmark_boards(count, seed)
+    simulators = [MergeGameSimulator(board) for board in boards]
+    pairs = [(simulator, action) for simulator in simulators for action in simulator.candidate_actions()]
+
+    def simulate_call(simulator, action):
+        return lambda: simulator.simulate(action, suppress_output=True)
+
+    def clusters_call(simulator):
+        board = bytearray(simulator.board)
+        return lambda: [simulator.find_clusters(board) for _ in range(100)]
+    suite = [
+        ("simulate", [simulate_call(simulator, action) for simulator, action in pairs], 3),
+        ("find_clusters (x100)", [clusters_call(simulator) for simulator in simulators], 3),
+        ("find_best_action", [simulator.find_best_action for simulator in simulators], 3),
+        ("find_best_action_by_fall", [simulator.find_best_action_by_fall for simulator in simulators], 3),
+        ("find_best_action_multistep", [simulator.find_best_action_multistep for simulator in simulators], 3),
+    ]
+    if depth > 2:
+        suite.append((f"search (depth={depth})",
+                      [lambda simulator=simulator: simulator.search(depth) for simulator in simulators], 1))
+    scored = [[] for _ in suite]
+    for _ in range(rounds):
+        for (name, calls, repeat), samples in zip(suite, scored):
+            before = calibrate()
+            result = measure(name, calls, repeat)
+            samples.append((result['p50_ms'] / ((before + calibrate()) / 2 * 1000), result))
+    results = []
+    for samples in scored:
+        score, result = min(samples, key=lambda sample: sample[0])
+        results.append(dict(result, score=score, noise=max(sample[0] for sample in samples) / score))
+    return results
+
+def print_results(results, baseline=None):
+    """
+    計測結果を表で表示する。baseline（以前の run_suite の結果）があれば score の比と退行の閾値
+    （REGRESSION_RATIO に両方の noise の大きい方を掛けた値）も表示し、退行の数を返す。
+    """
+    previous = {result['name']: result for result in baseline or []}
+    regressions = 0
+    print(f"{'関数':<30}{'回数':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'sim/秒':>10}{'peak KiB':>10}"
+          + ("  score 比（閾値）" if baseline else ""))
+    for result in results:
+        rate = result['simulations_per_sec']
+        line = (f"{result['name']:<30}{result['calls']:>6}{result['p50_ms']:>10.3f}{result['p90_ms']:>10.3f}"
+                f"{result['p99_ms']:>10.3f}{'-' if not rate else f'{rate:,.0f}':>10}{result['peak_kib']:>10.1f}")
+        old = previous.get(result['name'])
+        if old and old.get('score'):
+            ratio = result['score'] / old['score']
+            threshold = REGRESSION_RATIO * max(result['noise'], old['noise'])
+            line += f"  {ratio:.2f}x（{threshold:.2f}x）"
+            if ratio > threshold:
+                line += " 退行"
+                regressions += 1
+        print(line)
+    return regressions
+
+def bench_gravity(count=5000, seed=0):
+    """apply_gravity 単体と、simulate（キャッシュなし）全体での落下処理の比較結果を表示する"""
+    boards = random_boards(count, seed)
+    table, listed = MergeGameSimulator(boards[0]), ListGravitySimulator(boards[0])
+    for board in boards:
+        a, b = bytearray(board), bytearray(board)
+        table.apply_gravity(a)
+        listed.apply_gravity(b)
+        assert a == b
+
+    def run(simulator):
+        return lambda: [simulator.apply_gravity(bytearray(board)) for board in boards]
+    t_list, t_table = best_of(run(listed)), best_of(run(table))
+    print(f"apply_gravity ({count} 盤面): list {t_list * 1000:.1f} ms, table {t_table * 1000:.1f} ms "
+          f"({t_list / t_table:.2f}x)")
+
+    def chains(cls):
+        simulators = [cls(board) for board in boards[:count // 10]]
+        actions = [simulator.candidate_actions() for simulator in simulators]
+        return lambda: [simulator._simulate_chain(action, 20, True, True)
+                        for simulator, acts in zip(simulators, actions) for action in acts]
+    n = sum(len(MergeGameSimulator(board).candidate_actions()) for board in boards[:count // 10])
+    t_list, t_table = best_of(chains(ListGravitySimulator)), best_of(chains(MergeGameSimulator))
+    print(f"simulate ({n} 手): list {n / t_list:,.0f} 手/秒, table + merge_and_settle {n / t_table:,.0f} 手/秒 "
+          f"({t_list / t_table:.2f}x)")
+
+def format_board(board, action=None, header_color="gray"):
+    """
+    比較用: pandas の Styler による盤面の表示（board_view.board_html の以前の実装）。
+    盤面 (list-of-lists または pack_board 形式の bytes) を pandas の DataFrame に変換する。
+    ・None（欠損値）は0に置換し、すべて整数で表示する。
+    ・行・列ラベルは1〜BOARD_SIZEに設定する。
+    ・action が指定される場合（("add", r, c) または ("remove", r, c)）は、
+      対象セルを "add" は赤、"remove" は青でハイライトする。
+    ・ヘッダーのラベルは header_color で表示。
+    """
+    import pandas as pd
+    df = pd.DataFrame(unpack_board(board))
+    df = df.fillna(0).astype(int)
+    df.index = [i + 1 for i in range(len(df))]
+    df.columns = [i + 1 for i in range(len(df.columns))]
+
+    def highlight_action(df):
+        styled = pd.DataFrame("", index=df.index, columns=df.columns)
+        if action is not None:
+            act_type, act_r, act_c = action
+            if act_type == "add":
+                styled.at[act_r+1, act_c+1] = "background-color: red"
+            elif act_type == "remove":
+                styled.at[act_r+1, act_c+1] = "background-color: blue"
+        return styled
+
+    styler = df.style.apply(highlight_action, axis=None)
+    header_styles = [
+        {'selector': 'th.col_heading.level0', 'props': f'background-color: {header_color};'},
+        {'selector': 'th.row_heading.level0', 'props': f'background-color: {header_color};'}
+    ]
+    styler = styler.set_table_styles(header_styles)
+    return styler
+
+def format_trace(trace, header_color="gray"):
+    """
+    比較用: pandas の Styler による経過の表示（board_view.trace_html の以前の実装）。
+    simulate(trace=True) の経過を1つの表にする。"Initial board"（対象セルをハイライト）と
+    "After fall n" の各盤面を縦に並べ、行ラベルは (見出し, 行番号) の2段にする。
+    """
+    import pandas as pd
+    frames = [("Initial board", trace['initial'])]
+    frames += [(f"After fall {n}", step['board']) for n, step in enumerate(trace['falls'], 1)]
+    df = pd.concat({label: pd.DataFrame(unpack_board(board)).fillna(0).astype(int) for label, board in frames})
+    df.index = df.index.set_levels([i + 1 for i in range(len(df.index.levels[1]))], level=1)
+    df.columns = [i + 1 for i in range(len(df.columns))]
+    df = df.reindex([label for label, _ in frames], level=0)
+
+    def highlight_action(df):
+        styled = pd.DataFrame("", index=df.index, columns=df.columns)
+        act_type, act_r, act_c = trace['action']
+        color = {"add": "red", "remove": "blue"}.get(act_type)
+        if color is not None:
+            styled.at[("Initial board", act_r+1), act_c+1] = f"background-color: {color}"
+        return styled
+
+    styler = df.style.apply(highlight_action, axis=None)
+    header_styles = [
+        {'selector': 'th.col_heading.level0', 'props': f'background-color: {header_color};'},
+        {'selector': 'th.row_heading', 'props': f'background-color: {header_color};'}
+    ]
+    return styler.set_table_styles(header_styles)
+
+def bench_render(count=500, seed=0):
+    """
+    盤面描画を比較する: format_board / format_trace（pandas Styler の HTML）と board_view の
+    board_html / trace_html（HTML テンプレート）の1件あたりの時間と、出力の大きさ（UTF-8 のバイト数）。
+    """
+    from board_view import board_html, trace_html
+    boards = random_boards(count, seed)
+    actions = [MergeGameSimulator(board).candidate_actions()[0] for board in boards]
+    for board, action in zip(boards, actions):
+        assert board_html(board, action).count("<td") == format_board(board, action).to_html().count("<td")
+
+    def report(name, render_styler, render_html):
+        styler_size = sum(len(render_styler(k).encode()) for k in range(count)) / count
+        html_size = sum(len(render_html(k).encode()) for k in range(count)) / count
+        t_styler = best_of(lambda: [render_styler(k) for k in range(count)], repeat=3) / count
+        t_html = best_of(lambda: [render_html(k) for k in range(count)], repeat=3) / count
+        print(f"{name}: Styler {t_styler * 1e6:,.0f} us / {styler_size:,.0f} B, "
+              f"HTML {t_html * 1e6:,.1f} us / {html_size:,.0f} B ({t_styler / t_html:,.0f}x 速い, "
+              f"{styler_size / html_size:.1f}x 小さい)")
+    report("盤面", lambda k: format_board(boards[k], actions[k]).to_html(),
+           lambda k: board_html(boards[k], actions[k]))
+    traces = [MergeGameSimulator(board).simulate(action, trace=True)[3] for board, action in zip(boards, actions)]
+    report("経過", lambda k: format_trace(traces[k]).to_html(), lambda k: trace_html(traces[k]))
+
+def bench_ocr(count=200, seed=0):
+    """
+    ocr_worker の数字専用の認識モデルを比較する: fp32（量子化なし）、動的 int8 量子化（easyocr の CPU の既定）、
+    int8 + TorchScript（optimize_recognizer）。1〜20 の数字を描いたセル画像 count 枚の正解率、
+    25 セル（1盤面）のバッチ1回あたりの時間、メモリ上の重みの大きさを表示する。
+    fp32 より正解率が下がったものがあれば True を返す。
+    """
+    import cv2
+    import numpy as np
+    import torch
+    from ocr_worker import DIGIT_CHARS, RECOG_HEIGHT, load_reader, recognize_crops
+    rng = random.Random(seed)
+    fonts = [cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_TRIPLEX]
+    labels, crops = [], []
+    for k in range(count):
+        label = str(rng.randint(1, 20))
+        background = rng.randint(170, 255)
+        canvas = np.full((100, 140), background, np.uint8)
+        cv2.putText(canvas, label, (10, 75), rng.choice(fonts), rng.uniform(1.4, 2.2), rng.randint(0, 60),
+                    rng.randint(2, 4))
+        canvas = np.clip(canvas + np.random.default_rng(seed + k).normal(0, 6, canvas.shape), 0, 255).astype(np.uint8)
+        ys, xs = np.nonzero(canvas < background - 60)
+        crop = canvas[max(0, ys.min() - 4):ys.max() + 5, max(0, xs.min() - 4):xs.max() + 5]
+        width = max(1, round(RECOG_HEIGHT * crop.shape[1] / crop.shape[0]))
+        labels.append(label)
+        crops.append(cv2.resize(crop, (width, RECOG_HEIGHT), interpolation=cv2.INTER_LANCZOS4))
+    batches = [list(enumerate(crops[start:start + BOARD_CELLS], start)) for start in range(0, count, BOARD_CELLS)]
+
+    def tensor_bytes(value):
+        # テンソル（LSTM・Linear のパック済みパラメータは __getstate__ の中身）のバイト数の合計
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (list, tuple)):
+            return sum(tensor_bytes(item) for item in value)
+        if isinstance(value, dict):
+            return sum(tensor_bytes(item) for item in value.values())
+        if isinstance(value, torch.ScriptObject):
+            return tensor_bytes(value.__getstate__())
+        return 0
+
+    def model_size(model):
+        # メモリ上の重みの大きさ。凍結した TorchScript の重みはグラフの定数（畳み込みは MKLDNN のテンソル）になる
+        total = tensor_bytes(model.state_dict())
+        if isinstance(model, torch.jit.ScriptModule):
+            for node in model.graph.nodes():
+                if node.kind() == "prim::ConstantMKLDNNTensor":
+                    total += tensor_bytes(node.t("value"))
+                elif node.kind() == "prim::Constant" and node.hasAttribute("value"):
+                    total += tensor_bytes(node.output().toIValue())
+        return f"重み {total / 2**20:.1f} MiB"
+
+    variants = [("fp32", load_reader(True, quantize=False, optimize=False)),
+                ("int8", load_reader(True, optimize=False)),
+                ("int8 + TorchScript", load_reader(True, optimize=True))]
+    if not isinstance(variants[2][1].recognizer, torch.jit.ScriptModule):
+        print("注意: TorchScript にできなかったため、最後の行は int8 のみです", file=sys.stderr)
+    print(f"数字の認識 ({count} セル, torch スレッド数 {torch.get_num_threads()}):")
+    accuracies = []
+    for name, reader in variants:
+        texts = {}
+        for batch in batches:
+            texts.update((idx, text) for idx, text, _ in recognize_crops(reader, batch, DIGIT_CHARS))
+        accuracy = sum(texts.get(k) == label for k, label in enumerate(labels)) / count
+        elapsed = best_of(lambda: [recognize_crops(reader, batch, DIGIT_CHARS) for batch in batches], repeat=3)
+        accuracies.append(accuracy)
+        print(f"  {name}: 正解率 {accuracy:.1%}, {elapsed / len(batches) * 1000:.1f} ms/盤面, "
+              f"{model_size(reader.recognizer)}")
+    return any(accuracy < accuracies[0] for accuracy in accuracies[1:])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="solver.py のシミュレーション・探索関数を計測する")
+    parser.add_argument("--boards", type=int, default=20, help="実際に近い盤面・長い連鎖の盤面それぞれの数")
+    parser.add_argument("--seed", type=int, default=0, help="盤面生成の乱数シード")
+    parser.add_argument("--depth", type=int, default=2, help="3以上なら search(depth) も計測する")
+    parser.add_argument("--rounds", type=int, default=SUITE_ROUNDS, help="全関数を計測する回数（最良の回の結果を使う）")
+    parser.add_argument("--json", help="結果を保存する JSON ファイル")
+    parser.add_argument("--compare", help="比較する以前の結果（--json で保存したファイル）")
+    parser.add_argument("--gravity", action="store_true", help="apply_gravity の比較だけを行う")
+    parser.add_argument("--render", action="store_true", help="盤面の描画の比較だけを行う")
+    parser.add_argument("--ocr", action="store_true", help="数字の認識モデルの比較だけを行う（easyocr・torch が必要）")
+    args = parser.parse_args(argv)
+    if args.gravity:
+        bench_gravity(seed=args.seed)
+        return 0
+    if args.render:
+        bench_render(seed=args.seed)
+        return 0
+    if args.ocr:
+        return 1 if bench_ocr(seed=args.seed) else 0
+
+    results = run_suite(args.boards, args.seed, args.depth, args.rounds)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        if not all('score' in result for result in baseline):
+            print("注意: 比較先に score がない（以前の形式の）ため、比較しません", file=sys.stderr)
+        if (saved['boards'], saved['seed'], saved['depth']) != (args.boards, args.seed, args.depth):
+            print("注意: 比較先と --boards/--seed/--depth が異なるため、盤面が同じではありません", file=sys.stderr)
+    regressions = print_results(results, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'boards': args.boards, 'seed': args.seed, 'depth': args.depth, 'rounds': args.rounds,
+                       'python': sys.version.split()[0], 'results': results}, f, ensure_ascii=False, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+# 盤面の Streamlit 表示（main.py・scan.py から利用する。solver.py は表示に依存しない）
+# 盤面は board_html（HTML テンプレート）で描画する（pandas の Styler との比較は benchmark.py --render）
+import html
+import os
+
+import streamlit as st
+
+from result_store import RESULT_STORE_ENTRIES, ResultStore
+from solver import BOARD_CELLS, BOARD_SIZE, MergeGameSimulator, pack_board
+
+# 1手候補のキャッシュ（cached_candidates の st.cache_data）の上限件数と保持秒数
+SEARCH_CACHE_ENTRIES = 1000
+SEARCH_CACHE_TTL = 60 * 60
+# 探索結果をサーバーの再起動後も残すファイル（複数のワーカーで同じファイルを共有できる）
+RESULT_STORE_PATH = os.environ.get("RESULT_STORE_PATH", "solved_boards.sqlite3")
+
+# board_html の表のスタイル（表ごとではなく、描画1回につき1つだけ出力する）
+BOARD_STYLE = (
+    "<style>"
+    "table.board {border-collapse: collapse; margin-bottom: 0.5rem}"
+    "table.board caption {caption-side: top; text-align: left}"
+    "table.board th, table.board td {border: 1px solid #ddd; padding: 2px 10px; text-align: right}"
+    "</style>"
+)
+# 5x5 の盤面の HTML テンプレート。{header} はヘッダーの色、{caption} は見出し、
+# {0}〜{BOARD_CELLS-1} はセルの値、{BOARD_CELLS}〜 はセルの style 属性（ハイライトしないセルは空）
+BOARD_TEMPLATE = (
+    '<table class="board">{caption}<tr><th style="background-color: {header}"></th>'
+    + "".join(f'<th style="background-color: {{header}}">{c + 1}</th>' for c in range(BOARD_SIZE))
+    + "</tr>"
+    + "".join(
+        f'<tr><th style="background-color: {{header}}">{r + 1}</th>'
+        + "".join(f"<td{{{BOARD_CELLS + r * BOARD_SIZE + c}}}>{{{r * BOARD_SIZE + c}}}</td>"
+                  for c in range(BOARD_SIZE))
+        + "</tr>"
+        for r in range(BOARD_SIZE))
+    + "</table>"
+)
+NO_STYLES = ("",) * BOARD_CELLS
+HIGHLIGHT_COLORS = {"add": "red", "remove": "blue"}
+
+def board_html(board, action=None, header_color="gray", caption=None):
+    """
+    benchmark.py の format_board と同じ見た目の表（1〜BOARD_SIZE のラベル、action の対象セルを "add" は赤・"remove" は青）を
+    pandas を使わずに BOARD_TEMPLATE から HTML で作る。BOARD_STYLE と合わせて st.markdown で表示する。
+    """
+    styles = NO_STYLES
+    if action is not None and action[0] in HIGHLIGHT_COLORS:
+        styles = list(NO_STYLES)
+        styles[action[1] * BOARD_SIZE + action[2]] = f' style="background-color: {HIGHLIGHT_COLORS[action[0]]}"'
+    return BOARD_TEMPLATE.format(*pack_board(board), *styles, header=header_color,
+                                 caption="" if caption is None else f"<caption>{html.escape(caption)}</caption>")
+
+def trace_html(trace, header_color="gray"):
+    """simulate(trace=True) の経過（"Initial board" と "After fall n"）を見出し付きの表の並びにする"""
+    parts = [board_html(trace['initial'], trace['action'], header_color, "Initial board")]
+    parts += [board_html(step['board'], None, header_color, f"After fall {n}")
+              for n, step in enumerate(trace['falls'], 1)]
+    return "".join(parts)
+
+def show_board(board, action=None, header_color="gray"):
+    """board_html の表を1つ表示する"""
+    st.markdown(BOARD_STYLE + board_html(board, action, header_color), unsafe_allow_html=True)
+
+class StreamlitSimulator(MergeGameSimulator):
+    """simulate(suppress_output=False) の経過を Streamlit に表示する MergeGameSimulator"""
+
+    # 盤面のヘッダーの色
+    header_color = "gray"
+
+    def display_trace(self, trace):
+        """経過の全盤面を trace_html でまとめて1回で表示する"""
+        st.markdown(BOARD_STYLE + trace_html(trace, self.header_color), unsafe_allow_html=True)
+        st.markdown("---")
+
+@st.cache_data(max_entries=SEARCH_CACHE_ENTRIES, ttl=SEARCH_CACHE_TTL, show_spinner=False)
+def cached_candidates(board, max_value):
+    """
+    evaluate_candidates の結果を (盤面, max_value) ごとにキャッシュして返す。
+    board は pack_board 形式の bytes を渡す（Streamlit の再実行や他のセッションでも同じ盤面なら再計算しない）。
+    """
+    return MergeGameSimulator(board, vectorized=True).evaluate_candidates(max_value=max_value)
+
+def format_actions(actions):
+    """操作列を "【add】 (1,2) → 【remove】 (3,4)" の形式（1始まりの座標）にする"""
+    return " → ".join(f"【{op}】 ({r+1},{c+1})" for op, r, c in actions)
+
+@st.cache_resource
+def get_result_store():
+    """全セッションで共有する ResultStore（RESULT_STORE_PATH）を返す"""
+    return ResultStore(RESULT_STORE_PATH, RESULT_STORE_ENTRIES)
+
+def cached_search(board, max_value, depth, time_limit, parallel=False, rerun=False):
+    """
+    先読み（depth 手まで、time_limit 秒で打ち切る）の結果を返す。board は pack_board 形式の bytes。
+    solve_steps で get_result_store() の保存済みの結果を使うか探索し、進捗バーと暫定の最良手順をその場で
+    更新する（表示は最後に消す）。parallel=True の場合は並列に探索し、途中経過は出さない（時間上限は同じく守る）。
+    最後まで探索した結果（'complete' が True）だけが get_result_store() に保存されて全セッションで共有される。
+    直前の結果はこのセッションの再実行で表示し直すためにだけ session_state に残す（時間切れの結果を
+    他のセッションに返さないため、st.cache_data は使わない）。rerun=True（「実行」を押したとき）は探索し直す。
+    戻り値は search_deepening_steps の最後の結果と同じ形式（'complete' が False なら時間切れ）。
+    """
+    key = (board, max_value, depth, time_limit, parallel)
+    last = st.session_state.get("last_search")
+    if not rerun and last is not None and last[0] == key:
+        return last[1]
+    simulator = MergeGameSimulator(board)
+    progress_bar = st.progress(0.0, text="先読み中…")
+    provisional = st.empty()
+    for best in simulator.solve_steps(max_depth=depth, max_value=max_value,
+                                      candidates=cached_candidates(board, max_value), time_limit=time_limit,
+                                      parallel=parallel, store=get_result_store()):
+        progress_bar.progress(best['progress'], text=f"先読み中… {best['progress']:.0%}")
+        provisional.write(f"暫定の最良手順: {format_actions(best['actions'])}（合計合成セル数: {best['merged']}）")
+    progress_bar.empty()
+    provisional.empty()
+    st.session_state.last_search = (key, best)
+    return best
+
+def solved_key(board, *params):
+    """「実行」で解いた盤面と設定を session_state に覚えておくためのキー（盤面が未入力なら None）"""
+    return None if board is None else (pack_board(board),) + params
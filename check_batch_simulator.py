@@ -0,0 +1,65 @@
+# batch_simulator.py（NumPy）と solver.py の _simulate_chain の結果を乱数盤面で比べる確認用スクリプト
+#   python check_batch_simulator.py              # 約 6万の (盤面, 操作) を比べ、一致しなければ終了コード 1
+#   python check_batch_simulator.py --boards 200 --seed 3
+# 盤面には空きを含むもの（"add" の1回目の合成先セルが先に落ちる場合、batch_simulator の inherit / previous の再現）、
+# 値の幅が狭く長い連鎖が起きるもの、MAX_CELL_VALUE に近い値のものを混ぜる。
+import argparse
+import random
+import sys
+
+from batch_simulator import simulate_many
+from solver import BOARD_CELLS, MAX_CELL_VALUE, MAX_MAX_VALUE, MergeGameSimulator
+
+def random_board(rng):
+    """比べる盤面 (bytes) を1つ返す（空き・値の幅・値の大きさを乱数で変える）"""
+    kind = rng.randrange(3)
+    if kind == 0:
+        low, high = 3, rng.choice([5, 6, 8])           # 空きを含む、値の幅が広い盤面
+    elif kind == 1:
+        low = rng.randint(3, 8)
+        high = low + rng.randint(1, 2)                  # 長い連鎖が起きやすい盤面
+    else:
+        high = MAX_CELL_VALUE
+        low = high - rng.randint(1, 3)                  # 1バイトの上限に近い盤面
+    empty_rate = rng.choice([0.0, 0.1, 0.25])
+    return bytes(0 if rng.random() < empty_rate else rng.randint(low, high) for _ in range(BOARD_CELLS))
+
+def check(count=2000, seed=0):
+    """
+    count 個の盤面の全候補操作を simulate_many と _simulate_chain で計算し、(比べた数, 不一致のリスト) を返す。
+    max_value は盤面ごとに小さい値・既定値・MAX_MAX_VALUE から選ぶ。
+    """
+    rng = random.Random(seed)
+    boards, actions, expected, settings = [], [], [], []
+    for _ in range(count):
+        board = random_board(rng)
+        max_value = rng.choice([5, 6, 8, 20, MAX_MAX_VALUE])
+        simulator = MergeGameSimulator(board)
+        for action in simulator.candidate_actions():
+            boards.append(board)
+            actions.append(action)
+            expected.append(simulator._simulate_chain(action, max_value, True, True))
+            settings.append(max_value)
+    mismatches = []
+    # simulate_many は max_value ごとにまとめて呼ぶ
+    for max_value in sorted(set(settings)):
+        indices = [k for k, value in enumerate(settings) if value == max_value]
+        results = simulate_many([boards[k] for k in indices], [actions[k] for k in indices], max_value)
+        mismatches.extend((boards[k], actions[k], max_value, result, expected[k])
+                          for k, result in zip(indices, results) if result != expected[k])
+    return len(actions), mismatches
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="batch_simulator と solver の連鎖シミュレーションの結果を比べる")
+    parser.add_argument("--boards", type=int, default=2000, help="比べる盤面の数")
+    parser.add_argument("--seed", type=int, default=0, help="盤面生成の乱数シード")
+    args = parser.parse_args(argv)
+    total, mismatches = check(args.boards, args.seed)
+    for board, action, max_value, got, expected in mismatches[:10]:
+        print(f"不一致: board={list(board)} action={action} max_value={max_value} "
+              f"batch={got} solver={expected}")
+    print(f"{total} 件中 {len(mismatches)} 件が不一致")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# main2.py のセルの読み取り方式を比べる確認用スクリプト: まとめて認識する方式（prepare_cell で文字の周りを切り出し、
+# 全セルを recognize_crops に1回で通す。main2.py の既定）と、以前のセルごとの readtext（readtext_cell）
+#   python check_cell_ocr.py board1.png board2.png   # 盤面の格子だけを切り出した画像（main2.py の「自動選択された抽出領域」）で比べる
+#   python check_cell_ocr.py --boards 20 --seed 3     # 画像を指定しなければ、数字を描いた合成の盤面で比べる
+# どちらも main2.py の既定と同じ ja/en の Reader（学習済みの重み）で読み、数字の文字列が違うセルを表示する。
+# 不一致の割合が --max-mismatch を超えるか、正解がわかる合成の盤面でまとめて認識する方式の正解率が
+# readtext より低ければ終了コード 1。
+import argparse
+import random
+import sys
+
+import cv2
+import numpy as np
+
+from ocr_worker import load_reader, prepare_cell, readtext_cell, recognize_crops, split_cells
+
+ROWS = 5
+COLS = 5
+CELL_SIZE = 100  # 合成の盤面の1セルの大きさ（ピクセル）
+FONTS = [cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_TRIPLEX]
+
+def synthetic_board(rng):
+    """格子線と数字（1〜20、一部は空欄）を描いた盤面の BGR 画像と、セルごとの正解の文字列（行優先）を返す"""
+    background = rng.randint(170, 255)
+    image = np.full((ROWS * CELL_SIZE, COLS * CELL_SIZE, 3), background, np.uint8)
+    labels = []
+    for r in range(ROWS):
+        for c in range(COLS):
+            x, y = c * CELL_SIZE, r * CELL_SIZE
+            cv2.rectangle(image, (x, y), (x + CELL_SIZE - 1, y + CELL_SIZE - 1), (90, 90, 90), 2)
+            label = "" if rng.random() < 0.1 else str(rng.randint(1, 20))
+            if label:
+                font, scale, thickness = rng.choice(FONTS), rng.uniform(1.2, 1.8), rng.randint(2, 4)
+                (w, h), _ = cv2.getTextSize(label, font, scale, thickness)
+                ink = rng.randint(0, 60)
+                cv2.putText(image, label, (x + (CELL_SIZE - w) // 2, y + (CELL_SIZE + h) // 2), font, scale,
+                            (ink, ink, ink), thickness)
+            labels.append(label)
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).normal(0, 4, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8), labels
+
+def read_board(reader, image):
+    """
+    盤面の画像を ROWS x COLS のセルに分けて2つの方式で読み、
+    (まとめて認識した数字の文字列のリスト, readtext の数字の文字列のリスト) を行優先で返す。
+    """
+    cells = [cell for row in split_cells(image, ROWS, COLS) for cell in row]
+    crops = [prepare_cell(cell) for cell in cells]
+    image_list = [(k, crop) for k, crop in enumerate(crops) if crop is not None]
+    batched = [""] * len(cells)
+    if image_list:
+        for k, text, _ in recognize_crops(reader, image_list):
+            batched[k] = "".join(ch for ch in text if ch.isdigit())
+    per_cell = [readtext_cell(cell, reader)[0] for cell in cells]
+    return batched, per_cell
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="main2.py のまとめて認識する方式と readtext の方式でセルの数字を比べる")
+    parser.add_argument("images", nargs="*", help="盤面の格子だけを切り出した画像（省略すると合成の盤面）")
+    parser.add_argument("--boards", type=int, default=20, help="合成の盤面の数")
+    parser.add_argument("--seed", type=int, default=0, help="合成の盤面の乱数シード")
+    parser.add_argument("--max-mismatch", type=float, default=0.0, help="許容する不一致のセルの割合")
+    args = parser.parse_args(argv)
+    boards = []
+    if args.images:
+        for path in args.images:
+            image = cv2.imread(path)
+            if image is None:
+                parser.error(f"画像を読み込めません: {path}")
+            boards.append((path, image, None))
+    else:
+        rng = random.Random(args.seed)
+        boards = [(f"合成 {n + 1}", *synthetic_board(rng)) for n in range(args.boards)]
+    reader = load_reader(False)
+    total = mismatches = labelled = correct_batched = correct_per_cell = 0
+    for name, image, labels in boards:
+        batched, per_cell = read_board(reader, image)
+        for k, (got, expected) in enumerate(zip(batched, per_cell)):
+            total += 1
+            if got != expected:
+                mismatches += 1
+                print(f"不一致: {name} R{k // COLS + 1}C{k % COLS + 1} まとめて={got!r} readtext={expected!r}"
+                      + ("" if labels is None else f" 正解={labels[k]!r}"))
+        if labels is not None:
+            labelled += len(labels)
+            correct_batched += sum(got == label for got, label in zip(batched, labels))
+            correct_per_cell += sum(got == label for got, label in zip(per_cell, labels))
+    print(f"{total} セル中 {mismatches} セルが不一致")
+    if labelled:
+        print(f"正解率: まとめて認識 {correct_batched / labelled:.1%}, readtext {correct_per_cell / labelled:.1%}")
+    failed = mismatches > total * args.max_mismatch or correct_batched < correct_per_cell
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
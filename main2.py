@@ -4,8 +4,12 @@ import cv2
 import numpy as np
 from PIL import Image
 import pandas as pd
+import threading
+from multiprocessing import AuthenticationError
 import streamlit as st
-import easyocr
+
+from ocr_worker import (BLANK_STD, CELL_MARGIN, DIGIT_CHARS, OCR_WORKER_ADDRESS, load_reader, prepare_cell,
+                        readtext_cell, recognize_crops, recognize_remote, split_cells)
 
 st.set_page_config(layout="wide")
 st.title("自動グリッド OCR → CSV (アップロードのみで自動検出)")
@@ -13,19 +17,41 @@ st.title("自動グリッド OCR → CSV (アップロードのみで自動検
 # ----- 固定設定（必要ならここを 5,5 に変更） -----
 ROWS = 5
 COLS = 5
-OCR_LANGS = ["ja", "en"]  # easyocr の言語リスト
+# easyocr の言語・認識モデルの設定と、セル画像の切り出し（split_cells・prepare_cell）は ocr_worker.py にある
 # --------------------------------------------------
 
+# OCR の前に候補を形だけで順位付けする設定（上位 OCR_CANDIDATES 件だけを OCR で採点する）
+OCR_CANDIDATES = 2
+GEO_SIZE = 200                   # 形の採点に使う縮小画像の一辺
+GEO_WEIGHTS = (0.3, 0.3, 0.4)    # 縦横比・格子線・セルの文字の重み
+LATTICE_CONTRAST = 5.0           # 内側の格子線の位置の輝度勾配が、平均よりこの倍率ぶん強ければ満点
+
 uploaded = st.file_uploader("画像をアップロード", type=["png", "jpg", "jpeg"])
 debug = st.checkbox("デバッグ表示", value=False)
+# 数字専用の軽量モードは、学習済みの重みでの正解率・速度を ja/en の Reader と比べるまで既定では使わない
+digits_only = st.checkbox("数字専用の軽量モードで読む（英語の認識モデルのみ読み込み、文字検出なし）", value=False)
+# 以前の方式（セルごとに readtext）も選べるようにしておく（check_cell_ocr.py でまとめて認識する方式と比べられる）。
+# readtext は文字検出モデルを使うので、数字専用モードでは選べない
+per_cell = st.checkbox("セルごとに readtext で読む（以前の方式。文字検出を使うため遅い）", value=False,
+                       disabled=digits_only) and not digits_only
+
+# easyocr reader（スクリプトは実行のたびに読み直されるため、st.cache_resource で全セッションが1つを共有する。
+# digits_only=True は DIGIT_LANGS の認識モデルだけを読み込み、文字検出モデルは読み込まない）
+@st.cache_resource(show_spinner="OCR モデルを読み込み中...")
+def get_reader(digits_only=False):
+    return load_reader(digits_only)
 
-# easyocr reader
-_reader = None
-def get_reader():
-    global _reader
-    if _reader is None:
-        _reader = easyocr.Reader(OCR_LANGS, gpu=False)
-    return _reader
+# サーバーで最初に実行されたときに既定（ja/en）の Reader を裏で読み込み始め、画像のアップロード中に読み込みを済ませる
+# （読み込み中に get_reader を呼んだセッションは、同じ読み込みの完了を待つ）
+@st.cache_resource(show_spinner=False)
+def warm_up_reader():
+    thread = threading.Thread(target=get_reader, args=(False,), daemon=True)
+    thread.start()
+    return thread
+
+# OCR_WORKER_ADDRESS を指定した場合は ocr_worker.py のワーカーが認識するので、アプリでは読み込まない
+if not OCR_WORKER_ADDRESS:
+    warm_up_reader()
 
 def to_bgr(file) -> np.ndarray:
     img = Image.open(file).convert("RGB")
@@ -85,55 +111,62 @@ def detect_quad_candidates(img, max_candidates=8):
             results.append((rect, warped))
     return results
 
-def split_cells(warped, r, c):
-    h,w = warped.shape[:2]
-    ch = h // r
-    cw = w // c
-    cells = []
-    for i in range(r):
-        row = []
-        for j in range(c):
-            y1 = i*ch; x1 = j*cw
-            y2 = y1 + ch; x2 = x1 + cw
-            cell = warped[y1:y2, x1:x2]
-            row.append(cell)
-        cells.append(row)
-    return cells
-
-def ocr_cell_easyocr(cell, reader):
-    if cell is None or cell.size == 0:
-        return "", 0.0
-    img_rgb = cv2.cvtColor(cell, cv2.COLOR_BGR2RGB)
-    h,w = img_rgb.shape[:2]
-    if max(h,w) < 60:
-        img_rgb = cv2.resize(img_rgb, (0,0), fx=2.0, fy=2.0, interpolation=cv2.INTER_LINEAR)
+def recognize_cells(image_list, digits_only=False):
+    # ocr_worker.recognize_crops を OCR_WORKER_ADDRESS のワーカーで（未指定・ワーカーを使えない場合はこのプロセスで）実行する
+    # モデルの読み込みの失敗はページに表示する。このプロセスでの認識に失敗した場合は全セルを空欄にする（readtext の失敗と同じ扱い）
+    allowlist = DIGIT_CHARS if digits_only else None
+    if OCR_WORKER_ADDRESS:
+        try:
+            return recognize_remote(OCR_WORKER_ADDRESS, image_list, allowlist, digits_only)
+        except (OSError, EOFError, AuthenticationError):
+            pass  # 接続できない・待ち時間切れ・認証キーの不一致・ワーカーが応答せずに切断
+    reader = get_reader(digits_only)
     try:
-        # detail=1 を使って bbox と confidence を取得し信頼度評価に使う
-        raw = reader.readtext(img_rgb, detail=1)
+        return recognize_crops(reader, image_list, allowlist)
     except Exception:
-        raw = []
-    texts = []
-    confs = []
-    for box, text, conf in raw:
-        texts.append(text)
-        confs.append(conf)
-    combined = " ".join(texts)
-    digits = "".join(ch for ch in combined if ch.isdigit())
-    avg_conf = float(np.mean(confs)) if confs else 0.0
-    return digits, avg_conf
+        return []
+
+def ocr_cells_batched(cells, digits_only=False):
+    # split_cells の全セルを1回の認識でまとめて読む（readtext の文字検出はセルごとに走らせない）
+    # 数字専用モードでは DIGIT_CHARS 以外の文字を認識の候補から外す
+    # 戻り値はセルごとの (数字の文字列, 信頼度) を行ごとに並べた (table, conf_table)（空セルは ("", 0.0)）
+    r = len(cells); c = len(cells[0]) if cells else 0
+    crops = [prepare_cell(cell) for row in cells for cell in row]
+    image_list = [(idx, crop) for idx, crop in enumerate(crops) if crop is not None]
+    texts = [""] * (r*c)
+    confs = [0.0] * (r*c)
+    if image_list:
+        for idx, text, conf in recognize_cells(image_list, digits_only):
+            texts[idx] = "".join(ch for ch in text if ch.isdigit())
+            confs[idx] = float(conf)
+    table = [texts[i*c:(i+1)*c] for i in range(r)]
+    conf_table = [confs[i*c:(i+1)*c] for i in range(r)]
+    return table, conf_table
 
-def score_candidate_by_grid(warped, r, c, reader):
+def ocr_cells_readtext(cells):
+    # 以前の方式: セルごとに readtext_cell で読む（ワーカーは使わず、このプロセスの ja/en の Reader で読む）
+    # 戻り値は ocr_cells_batched と同じ (table, conf_table)
+    reader = get_reader(False)
+    table = []
+    conf_table = []
+    for row in cells:
+        results = [readtext_cell(cell, reader) for cell in row]
+        table.append([val for val, _ in results])
+        conf_table.append([conf for _, conf in results])
+    return table, conf_table
+
+def ocr_cells(cells, digits_only=False, per_cell=False):
+    # per_cell=True なら ocr_cells_readtext、それ以外は ocr_cells_batched で読む
+    if per_cell:
+        return ocr_cells_readtext(cells)
+    return ocr_cells_batched(cells, digits_only)
+
+def score_candidate_by_grid(warped, r, c, digits_only=False, per_cell=False):
     cells = split_cells(warped, r, c)
-    total_digits = 0
-    confs = []
-    # 短時間OCR（信頼度と数字の有無でスコア化）
-    for i in range(r):
-        for j in range(c):
-            cell = cells[i][j]
-            val, conf = ocr_cell_easyocr(cell, reader)
-            if val != "":
-                total_digits += 1
-            confs.append(conf)
+    # 短時間OCR（信頼度と数字の有無でスコア化）。既定では全セルを1回の認識でまとめて読む
+    table, conf_table = ocr_cells(cells, digits_only, per_cell)
+    total_digits = sum(1 for row in table for val in row if val != "")
+    confs = [conf for row in conf_table for conf in row]
     # 格子均一性スコア: 各セルサイズの分散は基本0なのでここでは warp 内で均等分割だから1.0 固定
     digit_ratio = total_digits / (r*c)
     avg_conf = float(np.mean(confs)) if confs else 0.0
@@ -141,31 +174,58 @@ def score_candidate_by_grid(warped, r, c, reader):
     score = 0.7 * digit_ratio + 0.3 * (avg_conf / 100.0)
     return score, digit_ratio, avg_conf
 
-def automatic_select_best_region(img, r, c):
-    reader = get_reader()
+def lattice_score(profile, n):
+    # 輝度勾配の投影 profile で、n 等分の内側の境界（格子線があるはずの位置）が平均よりどれだけ強いか（0〜1）
+    # 外枠は四角形の輪郭そのものなのでどの候補にもあり、判定には使わない
+    length = len(profile)
+    mean = profile.mean()
+    if length < 2*n or mean <= 0:
+        return 0.0
+    win = max(1, length // (n*10))
+    peaks = [profile[max(0, p-win):p+win+1].max() for p in (round(k*(length-1)/n) for k in range(1, n))]
+    return float(np.clip((np.mean(peaks) / mean - 1.0) / LATTICE_CONTRAST, 0.0, 1.0))
+
+def geometric_score(warped, r, c):
+    # OCR を使わない候補のスコア（0〜1）。縦横比が COLS:ROWS に近いか、r x c の格子線が投影に現れるか、
+    # 各セルに文字らしい濃淡があるか（セル内の濃淡の標準偏差が BLANK_STD 以上のセルの割合）の重み和
+    h,w = warped.shape[:2]
+    if h == 0 or w == 0:
+        return 0.0
+    aspect = min(w/h, c/r) / max(w/h, c/r)
+    gray = cv2.resize(cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY), (GEO_SIZE, GEO_SIZE), interpolation=cv2.INTER_AREA)
+    gx = np.abs(cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3))
+    gy = np.abs(cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3))
+    lattice = (lattice_score(gx.sum(axis=0), c) + lattice_score(gy.sum(axis=1), r)) / 2
+    inked = 0
+    for row in split_cells(gray, r, c):
+        for cell in row:
+            ch,cw = cell.shape[:2]
+            dy = int(ch * CELL_MARGIN); dx = int(cw * CELL_MARGIN)
+            inner = cell[dy:ch-dy, dx:cw-dx]
+            if inner.size and inner.std() >= BLANK_STD:
+                inked += 1
+    ink = inked / (r*c)
+    wa, wl, wi = GEO_WEIGHTS
+    return wa * aspect + wl * lattice + wi * ink
+
+def automatic_select_best_region(img, r, c, digits_only=False, per_cell=False):
     candidates = detect_quad_candidates(img, max_candidates=8)
+    # 全候補を geometric_score で順位付けし、上位 OCR_CANDIDATES 件だけを OCR で採点する
+    ranked = sorted(((geometric_score(warped, r, c), rect, warped) for rect, warped in candidates),
+                    key=lambda x: x[0], reverse=True)
     scored = []
-    for rect, warped in candidates:
-        score, ratio, avg_conf = score_candidate_by_grid(warped, r, c, reader)
+    for geo, rect, warped in ranked[:OCR_CANDIDATES]:
+        score, ratio, avg_conf = score_candidate_by_grid(warped, r, c, digits_only, per_cell)
         scored.append((score, ratio, avg_conf, rect, warped))
+        if ratio >= 1.0:
+            break  # 全セルで数字が読めたら残りの候補は OCR しない
     scored.sort(key=lambda x: x[0], reverse=True)
     best = scored[0] if scored else None
-    return best, scored
+    return best, scored, ranked
 
-def extract_table_from_warped(warped, r, c):
-    reader = get_reader()
+def extract_table_from_warped(warped, r, c, digits_only=False, per_cell=False):
     cells = split_cells(warped, r, c)
-    table = []
-    conf_table = []
-    for i in range(r):
-        rowvals = []
-        rowconfs = []
-        for j in range(c):
-            val, conf = ocr_cell_easyocr(cells[i][j], reader)
-            rowvals.append(val)
-            rowconfs.append(conf)
-        table.append(rowvals)
-        conf_table.append(rowconfs)
+    table, conf_table = ocr_cells(cells, digits_only, per_cell)
     return table, conf_table, cells
 
 # Main flow
@@ -175,7 +235,7 @@ if uploaded:
     st.image(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), use_column_width=True)
 
     st.subheader("自動検出中...")
-    best, all_scored = automatic_select_best_region(img, ROWS, COLS)
+    best, all_scored, ranked = automatic_select_best_region(img, ROWS, COLS, digits_only, per_cell)
     if best is None:
         st.error("候補が見つかりませんでした。別の画像を試してください。")
     else:
@@ -183,7 +243,7 @@ if uploaded:
         st.write(f"選択された候補スコア {score:.3f} 数字検出率 {ratio:.2f} 平均信頼度 {avg_conf:.1f}")
         st.image(cv2.cvtColor(warped, cv2.COLOR_BGR2RGB), caption="自動選択された抽出領域", use_column_width=True)
 
-        table, conf_table, cells = extract_table_from_warped(warped, ROWS, COLS)
+        table, conf_table, cells = extract_table_from_warped(warped, ROWS, COLS, digits_only, per_cell)
         df = pd.DataFrame(table)
         st.subheader("抽出結果プレビュー")
         st.dataframe(df)
@@ -195,6 +255,10 @@ if uploaded:
             for idx, (s, rratio, aconf, rect, warped_cand) in enumerate(all_scored):
                 st.write(f"候補 {idx+1} スコア {s:.3f} 検出率 {rratio:.2f} 平均conf {aconf:.1f}")
                 st.image(cv2.cvtColor(warped_cand, cv2.COLOR_BGR2RGB), width=240)
+            st.subheader("形状スコアによる候補の順位（OCR 前）")
+            for idx, (geo, rect, warped_cand) in enumerate(ranked):
+                st.write(f"順位 {idx+1} 形状スコア {geo:.3f}")
+                st.image(cv2.cvtColor(warped_cand, cv2.COLOR_BGR2RGB), width=240)
             st.subheader("セル単位プレビュー")
             for i in range(ROWS):
                 cols_ui = st.columns(ROWS)
@@ -0,0 +1,295 @@
+# セル画像の数字認識（main2.py から利用する）と、認識モデルを1つだけ読み込んで複数のアプリに提供するワーカー
+#   python ocr_worker.py                          # 127.0.0.1:8765 で待ち受ける
+#   OCR_WORKER_ADDRESS=127.0.0.1:8765 streamlit run main2.py   # main2.py の認識をワーカーに任せる
+# ワーカーは multiprocessing.connection（HMAC 認証付き）で、既定では localhost だけで待ち受ける。
+# 要求は pickle でやり取りするため、認証キーを知っているプロセス以外からは接続させない。キーは環境変数
+# OCR_WORKER_AUTHKEY で渡すか、指定しなければワーカーが起動時にランダムに作って OCR_WORKER_KEY_FILE
+# （所有者だけが読み書きできるファイル）に書き、同じユーザーのアプリはそのファイルを読む。
+import argparse
+import os
+import secrets
+import socket
+import threading
+
+import cv2
+import easyocr
+import numpy as np
+import torch
+from easyocr.recognition import get_text
+
+OCR_LANGS = ["ja", "en"]  # easyocr の言語リスト
+DIGIT_LANGS = ["en"]      # 数字専用モードで読み込む認識モデルの言語（英語の認識モデルが最も小さい）
+DIGIT_CHARS = "0123456789"
+RECOG_HEIGHT = 64         # easyocr の認識モデルの入力の高さ
+
+# ワーカーの待ち受けアドレス（"host:port"）。OCR_WORKER_ADDRESS が空ならアプリ内で認識する
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+OCR_WORKER_ADDRESS = os.environ.get("OCR_WORKER_ADDRESS", "")
+# OCR_WORKER_AUTHKEY を指定しない場合に、ワーカーが作った認証キーを置くファイル
+OCR_WORKER_KEY_FILE = os.environ.get("OCR_WORKER_KEY_FILE", os.path.join(os.path.expanduser("~"), ".ocr_worker_key"))
+# recognize_remote で接続・応答を待つ秒数（超えたら TimeoutError）
+OCR_WORKER_TIMEOUT = float(os.environ.get("OCR_WORKER_TIMEOUT", "30"))
+# CPU 推論の設定: torch の演算スレッド数（0 なら torch の既定）と、認識モデルを TorchScript にするか
+# （複数のアプリのワーカーが同じマシンで動く場合は、OCR_THREADS でスレッドの取り合いを抑える）。
+# TorchScript 化は、学習済みの english_g2 の重みで benchmark.py --ocr の正解率を確かめるまで既定では行わない
+OCR_THREADS = int(os.environ.get("OCR_THREADS", "0"))
+OCR_OPTIMIZE = os.environ.get("OCR_OPTIMIZE", "0") == "1"
+# optimize_recognizer で、最適化後のロジットが元のモデルとこれより大きく違えば最適化しない
+# （畳み込みの融合で 1e-3 程度の誤差は出る。文字の判定が変わるのはロジットの差が桁違いに大きい場合）
+OPTIMIZE_TOLERANCE = 1e-2
+
+def load_reader(digits_only=False, quantize=True, optimize=OCR_OPTIMIZE):
+    """
+    easyocr.Reader を読み込む（数秒かかる）。digits_only=True は DIGIT_LANGS の認識モデルだけを読み込み、
+    文字検出モデルは読み込まない（recognize_crops で使うのは認識モデルだけ）。
+    quantize は easyocr の動的 int8 量子化（CPU の既定）、optimize=True は optimize_recognizer を行う。
+    """
+    if OCR_THREADS:
+        torch.set_num_threads(OCR_THREADS)
+    if digits_only:
+        reader = easyocr.Reader(DIGIT_LANGS, gpu=False, detector=False, quantize=quantize)
+    else:
+        reader = easyocr.Reader(OCR_LANGS, gpu=False, quantize=quantize)
+    if optimize:
+        optimize_recognizer(reader)
+    return reader
+
+def optimize_recognizer(reader):
+    """
+    reader.recognizer（~/.EasyOCR/model の Model）を CPU 推論向けにする。LSTM と Linear を動的 int8 量子化し
+    （easyocr が quantize=True で量子化済みならそのまま）、Model.forward を torch.jit.trace で TorchScript にして
+    torch.jit.optimize_for_inference で畳み込みと BatchNorm の融合などを行う（時間の大半は量子化されない畳み込み）。
+    トレースに失敗した場合や、トレースと違うバッチ数・幅の入力で元のモデルと出力（ロジット）が
+    OPTIMIZE_TOLERANCE を超えて異なる場合は、量子化だけのモデルを使う。TorchScript にしたかを返す。
+    """
+    if reader.device != "cpu":
+        return False
+    model = reader.recognizer.eval()
+    if not any("quantized" in type(module).__module__ for module in model.modules()):
+        torch.quantization.quantize_dynamic(model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def example(batch, width):
+        # Model.forward の text は使われないので、形だけ合わせる
+        return torch.rand(batch, 1, RECOG_HEIGHT, width), torch.zeros(batch, 1, dtype=torch.long)
+    with torch.no_grad():
+        try:
+            traced = torch.jit.trace(model, example(1, RECOG_HEIGHT * 2))
+            try:
+                traced = torch.jit.optimize_for_inference(traced)
+            except Exception:
+                traced = torch.jit.freeze(traced)  # 融合できない環境では、定数化だけ行う
+            check = example(3, RECOG_HEIGHT * 5)
+            if not torch.allclose(traced(*check), model(*check), atol=OPTIMIZE_TOLERANCE):
+                return False
+        except Exception:
+            return False
+    reader.recognizer = traced
+    return True
+
+def recognize_crops(reader, image_list, allowlist=None):
+    """
+    切り出したセル画像をまとめて認識する。image_list は (番号, 高さ RECOG_HEIGHT のグレースケール画像) のリスト。
+    幅の違う画像は get_text が最大幅に合わせてパディングし、1つのバッチとして認識モデルに通す。
+    allowlist を指定すると、それ以外の文字を候補から外す（省略時は readtext と同じく reader の言語の文字）。
+    戻り値は (番号, 文字列, 信頼度) のリスト（image_list と同じ順）。
+    """
+    if not image_list:
+        return []
+    max_width = max([RECOG_HEIGHT] + [crop.shape[1] for _, crop in image_list])
+    ignore_char = "".join(set(reader.character) - set(allowlist or reader.lang_char))
+    return get_text(reader.character, RECOG_HEIGHT, max_width, reader.recognizer, reader.converter,
+                    image_list, ignore_char, "greedy", batch_size=len(image_list), workers=0,
+                    device=reader.device)
+
+def parse_address(address):
+    """"host:port" を multiprocessing.connection のアドレス (host, port) にする"""
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+def worker_authkey():
+    """ワーカーの認証キー（OCR_WORKER_AUTHKEY、なければ OCR_WORKER_KEY_FILE の内容）を返す。どちらもなければ None"""
+    key = os.environ.get("OCR_WORKER_AUTHKEY")
+    if key:
+        return key.encode()
+    try:
+        with open(OCR_WORKER_KEY_FILE, "rb") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def create_authkey(path=OCR_WORKER_KEY_FILE):
+    """ランダムな認証キーを作り、所有者だけが読み書きできるファイル path に書いて返す"""
+    key = secrets.token_hex(32).encode()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.chmod(path, 0o600)  # すでにあったファイルの権限も揃える
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+def recognize_remote(address, image_list, allowlist=None, digits_only=False, timeout=OCR_WORKER_TIMEOUT):
+    """
+    recognize_crops をワーカー（address）で実行し、同じ形式の結果を返す。
+    認証キーがない・一致しない場合は AuthenticationError、接続や応答を timeout 秒待っても
+    進まない場合は TimeoutError、ワーカーが応答せずに接続を閉じた場合は EOFError を送出する。
+    """
+    from multiprocessing.connection import AuthenticationError, Connection, answer_challenge, deliver_challenge
+    authkey = worker_authkey()
+    if authkey is None:
+        raise AuthenticationError(f"OCR_WORKER_AUTHKEY も {OCR_WORKER_KEY_FILE} もありません")
+    # Client は接続の待ち時間を指定できないため、接続してから Client と同じ手順で認証する
+    sock = socket.create_connection(parse_address(address), timeout=timeout)
+    sock.setblocking(True)
+    with Connection(sock.detach()) as connection:
+        # ワーカーからの認証の問いかけと、要求の結果をそれぞれ timeout 秒まで待つ
+        if not connection.poll(timeout):
+            raise TimeoutError(f"OCR ワーカー {address} が {timeout} 秒以内に応答しませんでした")
+        answer_challenge(connection, authkey)
+        deliver_challenge(connection, authkey)
+        connection.send((digits_only, image_list, allowlist))
+        if not connection.poll(timeout):
+            raise TimeoutError(f"OCR ワーカー {address} が {timeout} 秒以内に応答しませんでした")
+        result = connection.recv()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+# ----------------------------
+# セル画像
+# ----------------------------
+# セルをまとめて認識するときの設定（セルは切り出し済みなので文字検出を省き、認識モデルだけに通す）
+CELL_MARGIN = 0.08  # 格子の線を除くため、セルの上下左右から削る割合
+BLANK_STD = 8.0     # 濃淡の標準偏差がこれ未満のセルは空欄とみなす（readtext で文字が検出されない場合と同じ扱い）
+INK_PAD = 0.15      # 文字を囲む範囲に足す余白（文字の高さに対する割合）
+
+def split_cells(warped, r, c):
+    h,w = warped.shape[:2]
+    ch = h // r
+    cw = w // c
+    cells = []
+    for i in range(r):
+        row = []
+        for j in range(c):
+            y1 = i*ch; x1 = j*cw
+            y2 = y1 + ch; x2 = x1 + cw
+            cell = warped[y1:y2, x1:x2]
+            row.append(cell)
+        cells.append(row)
+    return cells
+
+def ink_bbox(gray):
+    # 大津の2値化で少ない方の画素を文字とみなし、それを囲む範囲 (y1, y2, x1, x2) を返す（なければ None）
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    ink = binary > 0
+    if ink.mean() > 0.5:
+        ink = ~ink
+    ys, xs = np.nonzero(ink)
+    if len(ys) == 0:
+        return None
+    return ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+
+def prepare_cell(cell):
+    # 格子の線を削ってグレースケールにし、文字の周りだけを切り出して高さを RECOG_HEIGHT にそろえる
+    # （readtext の文字検出の代わり。切り出すと幅も狭くなり、バッチの入力が小さくなる。空のセル・空欄は None）
+    if cell is None or cell.size == 0:
+        return None
+    h,w = cell.shape[:2]
+    dy = int(h * CELL_MARGIN); dx = int(w * CELL_MARGIN)
+    gray = cv2.cvtColor(cell[dy:h-dy, dx:w-dx], cv2.COLOR_BGR2GRAY)
+    if gray.size == 0 or gray.std() < BLANK_STD:
+        return None
+    box = ink_bbox(gray)
+    if box is not None:
+        y1, y2, x1, x2 = box
+        pad = max(2, int((y2 - y1) * INK_PAD))
+        gray = gray[max(0, y1-pad):y2+pad, max(0, x1-pad):x2+pad]
+    h,w = gray.shape
+    width = max(1, int(round(RECOG_HEIGHT * w / h)))
+    return cv2.resize(gray, (width, RECOG_HEIGHT), interpolation=cv2.INTER_LANCZOS4)
+
+def readtext_cell(cell, reader):
+    # 以前の方式: 1つのセルを readtext（文字検出 + 認識）で読み、(数字の文字列, 平均信頼度) を返す
+    # （文字検出モデルが必要なので、digits_only で読み込んだ Reader では使えない）
+    if cell is None or cell.size == 0:
+        return "", 0.0
+    img_rgb = cv2.cvtColor(cell, cv2.COLOR_BGR2RGB)
+    h,w = img_rgb.shape[:2]
+    if max(h,w) < 60:
+        img_rgb = cv2.resize(img_rgb, (0,0), fx=2.0, fy=2.0, interpolation=cv2.INTER_LINEAR)
+    try:
+        # detail=1 を使って bbox と confidence を取得し信頼度評価に使う
+        raw = reader.readtext(img_rgb, detail=1)
+    except Exception:
+        raw = []
+    texts = []
+    confs = []
+    for box, text, conf in raw:
+        texts.append(text)
+        confs.append(conf)
+    combined = " ".join(texts)
+    digits = "".join(ch for ch in combined if ch.isdigit())
+    avg_conf = float(np.mean(confs)) if confs else 0.0
+    return digits, avg_conf
+
+# ----------------------------
+# ワーカープロセス
+# ----------------------------
+# ワーカーが読み込んだ Reader（digits_only ごとに1つ）。認識モデルはスレッド間で共有し、推論は1つずつ行う
+_readers = {}
+_readers_lock = threading.Lock()
+_inference_lock = threading.Lock()
+
+def get_worker_reader(digits_only):
+    """ワーカー内の Reader を返す（初回だけ load_reader で読み込む）"""
+    with _readers_lock:
+        if digits_only not in _readers:
+            _readers[digits_only] = load_reader(digits_only)
+        return _readers[digits_only]
+
+def handle_connection(connection):
+    """1つの接続の要求 (digits_only, image_list, allowlist) に recognize_crops の結果（失敗時は例外）を返す"""
+    with connection:
+        try:
+            digits_only, image_list, allowlist = connection.recv()
+            reader = get_worker_reader(digits_only)
+            with _inference_lock:
+                result = recognize_crops(reader, image_list, allowlist)
+        except Exception as e:
+            result = e
+        try:
+            connection.send(result)
+        except Exception:
+            connection.send(RuntimeError(repr(result)))  # pickle できない例外は文字列にして返す
+
+def serve(address=DEFAULT_ADDRESS, preload=(False,)):
+    """
+    address で要求を待ち受ける。preload の digits_only の Reader は起動時に読み込んでおく。
+    OCR_WORKER_AUTHKEY がなければ create_authkey で認証キーを作り直す（アプリは要求ごとにファイルを読む）。
+    """
+    from multiprocessing.connection import Listener
+    authkey = os.environ.get("OCR_WORKER_AUTHKEY", "").encode()
+    if not authkey:
+        authkey = create_authkey()
+        print(f"認証キーを {OCR_WORKER_KEY_FILE} に作成しました", flush=True)
+    for digits_only in preload:
+        get_worker_reader(digits_only)
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        print(f"OCR ワーカーを {address} で起動しました", flush=True)
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception:
+                continue  # 認証に失敗した接続などは無視する
+            threading.Thread(target=handle_connection, args=(connection,), daemon=True).start()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="main2.py のセル認識を引き受ける OCR ワーカー")
+    parser.add_argument("--address", default=OCR_WORKER_ADDRESS or DEFAULT_ADDRESS, help="待ち受けアドレス host:port")
+    parser.add_argument("--full", action="store_true", help="ja/en の Reader に加えて数字専用モードの Reader も起動時に読み込む")
+    parser.add_argument("--threads", type=int, default=OCR_THREADS, help="torch の演算スレッド数（0 なら既定）")
+    args = parser.parse_args(argv)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    serve(args.address, preload=(False, True) if args.full else (False,))
+
+if __name__ == "__main__":
+    main()
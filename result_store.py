@@ -0,0 +1,121 @@
+# 解いた盤面の先読み結果をディスクに保存する（サーバーを再起動しても、同じ盤面は解き直さない）
+# SQLite の WAL モードで開くので、複数の Streamlit ワーカーや batch_solve.py のプロセスから同時に読み書きできる。
+# キーは (盤面, max_value, 先読み手数)。盤面は左右反転して正規化しない: 合成先の選び方（最も下の行の最も左）と
+# 同点の手順を列挙順で選ぶ規則が左右対称でないため、反転した盤面の最良手順は反転した手順になるとは限らない。
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# 保存する盤面数の上限（超えたら最後に使った時刻の古いものから消す）と、一度に消す割合
+RESULT_STORE_ENTRIES = 100000
+EVICT_FRACTION = 0.1
+# 上限を超えたかは put の EVICT_CHECK_INTERVAL 回ごとに数える（超える量はこの回数以下）
+EVICT_CHECK_INTERVAL = 100
+# 最後に使った時刻は、前回の更新からこの秒数が経った結果だけ更新する（取得の多くを読み取りだけにする）
+TOUCH_INTERVAL = 60.0
+# 書き込みが他のプロセスと重なったときに待つ秒数
+BUSY_TIMEOUT = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    board BLOB NOT NULL,
+    max_value INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    actions TEXT NOT NULL,
+    merged INTEGER NOT NULL,
+    final BLOB NOT NULL,
+    nodes INTEGER NOT NULL,
+    pruned INTEGER NOT NULL,
+    duplicates INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (board, max_value, depth)
+);
+CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+"""
+
+class ResultStore:
+    """
+    search の完全な結果（時間・局面数の上限で打ち切られていないもの）を SQLite に保存する。
+    接続はスレッド・プロセスごとに作る（Streamlit のセッションはスレッド、並列探索は fork したプロセスで動くため）。
+    SQLite のエラー（読み取り専用のディレクトリ、ロックの待ち時間切れなど）は保存・取得しなかったものとして扱い、
+    探索そのものは止めない。
+    """
+
+    def __init__(self, path, max_entries=RESULT_STORE_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+    def _connection(self):
+        """このスレッド・プロセスの接続を返す（fork 後は親の接続を使わずに開き直す）"""
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def get(self, board, max_value, depth):
+        """
+        (盤面, max_value, 先読み手数) の保存済みの結果を search の戻り値と同じ形式の辞書で返す（なければ None）。
+        board は pack_board 形式の bytes。取得した結果は最後に使った時刻を更新する（追い出しの順序に使う）。
+        時刻の更新は TOUCH_INTERVAL ごとに行い、書き込みが他のプロセスと重なって失敗しても結果はそのまま返す。
+        """
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                "SELECT actions, merged, final, nodes, pruned, duplicates, last_used FROM results "
+                "WHERE board = ? AND max_value = ? AND depth = ?", (board, max_value, depth)).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        actions, merged, final, nodes, pruned, duplicates, last_used = row
+        now = time.time()
+        if now - last_used >= TOUCH_INTERVAL:
+            try:
+                connection.execute("UPDATE results SET last_used = ? WHERE board = ? AND max_value = ? AND depth = ?",
+                                   (now, board, max_value, depth))
+            except sqlite3.Error:
+                pass
+        return {'actions': tuple(tuple(action) for action in json.loads(actions)), 'merged': merged,
+                'board': bytes(final), 'nodes': nodes, 'pruned': pruned, 'duplicates': duplicates}
+
+    def put(self, board, max_value, depth, result):
+        """
+        search の結果 result を保存する。EVICT_CHECK_INTERVAL 回ごとに件数を数え、max_entries を超えていたら
+        古いものを EVICT_FRACTION の割合だけ消す。
+        """
+        self._puts += 1
+        try:
+            connection = self._connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (board, max_value, depth, json.dumps(result['actions']), result['merged'], bytes(result['board']),
+                 result['nodes'], result['pruned'], result['duplicates'], time.time()))
+            if self._puts % EVICT_CHECK_INTERVAL:
+                return
+            count = connection.execute("SELECT count(*) FROM results").fetchone()[0]
+            if count > self.max_entries:
+                evict = count - self.max_entries + int(self.max_entries * EVICT_FRACTION)
+                connection.execute("DELETE FROM results WHERE rowid IN "
+                                   "(SELECT rowid FROM results ORDER BY last_used LIMIT ?)", (evict,))
+        except sqlite3.Error:
+            pass
+
+    def info(self):
+        """利用状況 {'hits', 'misses', 'size', 'maxsize'} を返す"""
+        try:
+            size = self._connection().execute("SELECT count(*) FROM results").fetchone()[0]
+        except sqlite3.Error:
+            size = 0
+        return {'hits': self.hits, 'misses': self.misses, 'size': size, 'maxsize': self.max_entries}
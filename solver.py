@@ -0,0 +1,727 @@
+# 百鬼夜行の盤面シミュレータと探索（標準ライブラリだけで動く。vectorized=True の場合のみ NumPy を使う）
+# main.py・scan.py の表示は board_view.py が担当し、バッチ処理や並列探索のワーカーはこのモジュールだけを import する
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 定数
+BOARD_SIZE = 5
+BOARD_CELLS = BOARD_SIZE * BOARD_SIZE
+DEFAULT_MAX_VALUE = 20
+MAX_SEARCH_DEPTH = 4
+SEARCH_WORKERS = os.cpu_count() or 1
+# 盤面は 1セル 1バイトで持つ。入力できるセルの値は "add" で 1 増えても 1バイトに収まる MAX_CELL_VALUE まで、
+# max_value は合成後に残る値（max_value 未満）が 1バイトに収まる MAX_CELL_VALUE + 1 まで
+MAX_CELL_VALUE = 254
+MAX_MAX_VALUE = MAX_CELL_VALUE + 1
+
+# 各セル番号 (r*BOARD_SIZE+c) の上下左右の隣接セル番号
+NEIGHBORS = tuple(
+    tuple(
+        (r + dr) * BOARD_SIZE + (c + dc)
+        for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]
+        if 0 <= r + dr < BOARD_SIZE and 0 <= c + dc < BOARD_SIZE
+    )
+    for r in range(BOARD_SIZE)
+    for c in range(BOARD_SIZE)
+)
+
+# COLUMN_ABOVE[i]: セル i と同じ列で、i 以上（上側）にあるセル番号（重力で動きうる範囲）
+COLUMN_ABOVE = tuple(
+    tuple(range(i % BOARD_SIZE, i + 1, BOARD_SIZE))
+    for i in range(BOARD_CELLS)
+)
+
+# bytes.translate で列の各セルを 0（空）/ 1（数字あり）に変換する表
+OCCUPANCY = bytes([0]) + bytes([1]) * 255
+
+# GRAVITY_TABLE[占有パターン]: 列（上から下）の占有パターンごとに、落下後の列の上に詰める空セル（bytes）。
+# すでに下に詰まっている列は None（書き換え不要）
+GRAVITY_TABLE = {
+    pattern: None if pattern == bytes(pattern.count(0)) + bytes([1]) * pattern.count(1) else bytes(pattern.count(0))
+    for pattern in (bytes((mask >> r) & 1 for r in range(BOARD_SIZE)) for mask in range(1 << BOARD_SIZE))
+}
+
+def pack_board(board):
+    """
+    盤面を BOARD_CELLS バイトの bytes（行優先、0 は空セル）に変換する。
+    list-of-lists の None と 0 はどちらも空セルとして扱う。
+    すでに bytes / bytearray の場合は不変な bytes にして返す。
+    値が 0〜MAX_CELL_VALUE の範囲外なら ValueError を送出する。
+    """
+    if isinstance(board, (bytes, bytearray)):
+        return bytes(board)
+    values = [v or 0 for row in board for v in row]
+    for v in values:
+        if not 0 <= v <= MAX_CELL_VALUE:
+            raise ValueError(f"セルの値は 0〜{MAX_CELL_VALUE} で入力してください（{v}）")
+    return bytes(values)
+
+def check_max_value(max_value):
+    """max_value が 1〜MAX_MAX_VALUE の範囲外なら ValueError を送出する"""
+    if not 1 <= max_value <= MAX_MAX_VALUE:
+        raise ValueError(f"max_value は 1〜{MAX_MAX_VALUE} で指定してください（{max_value}）")
+
+def unpack_board(board):
+    """pack_board の逆変換。空セルを None にした list-of-lists を返す（list-of-lists はそのまま返す）。"""
+    if not isinstance(board, (bytes, bytearray)):
+        return board
+    return [[board[r * BOARD_SIZE + c] or None for c in range(BOARD_SIZE)] for r in range(BOARD_SIZE)]
+
+def merge_target_key(i):
+    """合成先セルの優先順位（最も下の行、その中で最も左の列）を与えるソートキー"""
+    return (-(i // BOARD_SIZE), i % BOARD_SIZE)
+
+def merge_upper_bound(board, moves, max_value=20):
+    """
+    盤面 (bytes) から残り moves 手で得られる合成セル数の上限（過大評価のみ、過小評価しない）を返す。
+    ・値 v のセルが将来同時に存在しうる最大数 U(v) を、現在の個数・"add" による繰り上げ・
+      より小さい値のクラスタ合成から作られる分の合計で見積もり、U(v) >= 3 の値だけを数える。
+    ・合成1回ごとにセル数は少なくとも2減るため、合成セル数は盤面のセル数の1.5倍を超えない。
+    この2つの小さい方を返す。
+    """
+    counts = {}
+    cells = 0
+    for v in board:
+        if v:
+            counts[v] = counts.get(v, 0) + 1
+            cells += 1
+    if not cells:
+        return 0
+    top = max(max(counts), max_value)
+    reachable = [0] * (top + 1)  # reachable[v] = U(v)
+    mergeable = []  # U(w) >= 3 の値 w（小さい順）
+    bound = 0
+    for v in range(1, top + 1):
+        u = counts.get(v, 0)
+        if reachable[v - 1]:
+            u += min(moves, reachable[v - 1])
+        if v < max_value:
+            for w in mergeable:
+                u += reachable[w] // (v - w + 2)
+        reachable[v] = u
+        if u >= 3:
+            mergeable.append(v)
+            bound += u
+    return min(bound, cells * 3 // 2)
+
+def candidate_actions(board):
+    """盤面 (bytes) の空でないセルに対する "add" / "remove" を行優先の列挙順で返す"""
+    return [(op, r, c)
+            for r in range(BOARD_SIZE)
+            for c in range(BOARD_SIZE)
+            if board[r * BOARD_SIZE + c]
+            for op in ["add", "remove"]]
+
+def distinct_results(results):
+    """
+    (手順, 合計合成セル数, 結果盤面) の列を結果盤面ごとにまとめ、各盤面の代表だけを元の列挙順で返す。
+    代表は合計合成セル数が最大のもの（同点なら列挙順で先のもの）。同じ盤面からの続きは同じなので、
+    代表以外の手順から始まる手順が最良（同点時は手数・列挙順で先）として選ばれることはない。
+    """
+    kept = {}
+    for index, (sequence, total, board) in enumerate(results):
+        entry = kept.get(board)
+        if entry is None or total > entry[2]:
+            kept[board] = (index, sequence, total)
+    return [(sequence, total, board)
+            for board, (index, sequence, total) in sorted(kept.items(), key=lambda item: item[1][0])]
+
+def sequence_key(actions):
+    """
+    操作列の列挙順のキー（1手目から順に candidate_actions の順序で比べる辞書式順序）。
+    search で合成セル数・手数が同じ手順のうち、どれを選ぶかはこの順序で決まる。
+    """
+    return tuple((r, c, op == "remove") for op, r, c in actions)
+
+def improves(total, sequence, best):
+    """合計合成セル数 total の手順 sequence が best の手順より良いか（合成セル数、手数、列挙順の順に比べる）"""
+    if total != best['merged']:
+        return total > best['merged']
+    if len(sequence) != len(best['actions']):
+        return len(sequence) < len(best['actions'])
+    return sequence_key(sequence) < sequence_key(best['actions'])
+
+class SearchBudgetExceeded(Exception):
+    """search・search_deepening の時間・局面数の上限に達した（探索を打ち切るために内部で使う）"""
+
+# ----------------------------
+# MergeGameSimulator クラス
+# ----------------------------
+class MergeGameSimulator:
+    # simulate(suppress_output=True) の結果を (盤面, action, max_value) ごとに保持する LRU キャッシュ。
+    # 盤面・結果はどちらも不変な bytes なので、全インスタンス・全セッションで共有する。
+    CACHE_SIZE = 50000
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    cache_hits = 0
+    cache_misses = 0
+
+    def __init__(self, board, vectorized=False):
+        self.board = pack_board(board)  # 初期盤面（不変な bytes）
+        # True の場合、evaluate_candidates は batch_simulator（NumPy）で全候補をまとめて計算する
+        self.vectorized = vectorized
+        # find_clusters の作業バッファ（呼び出しごとに mark を進めて visited のクリアを省く）
+        self._marks = [0] * BOARD_CELLS
+        self._mark = 0
+        self._queue = [0] * BOARD_CELLS
+
+    def display_trace(self, trace):
+        """
+        simulate(suppress_output=False) の経過（simulate の trace を参照）をまとめて表示する。
+        このクラスは表示先を持たないので何もしない。board_view.StreamlitSimulator が上書きする。
+        """
+
+    @classmethod
+    def cache_info(cls):
+        """simulate キャッシュの利用状況 {'hits', 'misses', 'size', 'maxsize'} を返す"""
+        with cls._cache_lock:
+            return {'hits': cls.cache_hits, 'misses': cls.cache_misses,
+                    'size': len(cls._cache), 'maxsize': cls.CACHE_SIZE}
+
+    @classmethod
+    def cache_clear(cls):
+        """simulate キャッシュとヒット数・ミス数をクリアする"""
+        with cls._cache_lock:
+            cls._cache.clear()
+            cls.cache_hits = 0
+            cls.cache_misses = 0
+
+    def find_clusters(self, board, cells=None):
+        """
+        隣接する同じ数字のクラスタを検出する（各クラスタはセル番号 r*BOARD_SIZE+c のリスト）。
+        再帰は使わず、インスタンスが持つ作業バッファ上で幅優先に塗りつぶす。
+        cells を指定した場合はそのセルを含むクラスタだけを探す（差分探索）。
+        どちらの場合もクラスタは行優先で最初のセルの順に返す。
+        """
+        self._mark += 1
+        mark = self._mark
+        marks = self._marks
+        queue = self._queue
+        clusters = []
+        for i in (range(BOARD_CELLS) if cells is None else cells):
+            value = board[i]
+            if not value or marks[i] == mark:
+                continue
+            marks[i] = mark
+            queue[0] = i
+            head, tail = 0, 1
+            while head < tail:
+                for j in NEIGHBORS[queue[head]]:
+                    if board[j] == value and marks[j] != mark:
+                        marks[j] = mark
+                        queue[tail] = j
+                        tail += 1
+                head += 1
+            if tail >= 3:
+                clusters.append(queue[:tail])
+        if cells is not None and len(clusters) > 1:
+            clusters.sort(key=min)
+        return clusters
+
+    def dirty_cells(self, clusters, fall, user_action=None):
+        """
+        merge_clusters と apply_gravity の後に値が変わりうるセルの集合を返す。
+        各列で書き換えられた最も下のセルより上だけが落下で動くため、それ以外は前回のまま。
+        ただし 1回目の "add" の合成先セルの列は全体を対象にする。
+        """
+        cells = set()
+        for cluster in clusters:
+            for i in cluster:
+                cells.update(COLUMN_ABOVE[i])
+        if user_action and user_action[0] == "add" and fall == 0:
+            # 入力盤面に空きがあると "add" したセル自体が先に落ちており、合成値はその位置から下に落ちうる
+            cells.update(COLUMN_ABOVE[BOARD_CELLS - BOARD_SIZE + user_action[2]])
+        return cells
+
+    def merge_clusters(self, board, clusters, fall, user_action=None, max_value=20, events=None):
+        """
+        検出したクラスタを合成し、合成されたセル数を返す。
+        user_action が指定されている場合は、1手目ではその対象セルを優先的に更新する。
+        board は bytearray でその場で更新する。
+        events にリストを渡すと、クラスタごとに (セル番号のタプル, 合成先セル, 合成後の値（max_value 以上で消えた場合は 0)) を追加する。
+        """
+        total_merged_numbers = 0
+        for cluster in clusters:
+            base_value = board[cluster[0]]
+            new_value = base_value + (len(cluster) - 2)
+            total_merged_numbers += len(cluster)
+            if user_action and user_action[0] == "add" and fall == 0:
+                target = user_action[1] * BOARD_SIZE + user_action[2]
+            else:
+                target = min(cluster, key=merge_target_key)
+            for i in cluster:
+                board[i] = 0
+            if new_value < max_value:
+                board[target] = new_value
+            if events is not None:
+                events.append((tuple(cluster), target, new_value if new_value < max_value else 0))
+        return total_merged_numbers
+
+    def apply_gravity(self, board, columns=range(BOARD_SIZE)):
+        """
+        各列（columns で指定した列だけ）の数字を下に落下させる。
+        列の占有パターンで GRAVITY_TABLE を引き、すでに詰まっている列はそのまま残す。
+        """
+        for c in columns:
+            column = bytes(board[c::BOARD_SIZE])
+            padding = GRAVITY_TABLE[column.translate(OCCUPANCY)]
+            if padding is not None:
+                board[c::BOARD_SIZE] = padding + column.replace(b"\0", b"")
+
+    def merge_and_settle(self, board, clusters, fall, user_action=None, max_value=20, events=None):
+        """
+        merge_clusters の後、値を書き換えた列だけに apply_gravity を適用する。
+        合成セル数を返す（events は merge_clusters と同じ）。
+        """
+        merged = self.merge_clusters(board, clusters, fall, user_action=user_action, max_value=max_value,
+                                     events=events)
+        columns = {i % BOARD_SIZE for cluster in clusters for i in cluster}
+        if user_action and user_action[0] == "add" and fall == 0:
+            columns.add(user_action[2])
+        self.apply_gravity(board, columns)
+        return merged
+
+    def simulate(self, action, max_value=20, suppress_output=False, incremental=True, trace=False):
+        """
+        指定したアクション（("add", r, c) または ("remove", r, c)）を適用したときの連鎖シミュレーションを行う。
+        suppress_output=False の場合は、経過を display_trace でまとめて表示する（初期盤面は対象セルをハイライト）。
+        すでに空（0）のセルには "add" は適用されません。
+        self.board は書き換えず、作業用の bytearray 上で連鎖を計算する。
+        incremental=True の場合、2回目以降のクラスタ探索は前回の合成・落下で動いたセルの周辺だけを調べる。
+        suppress_output=True の場合は結果を LRU キャッシュから返す（表示・trace が必要な場合は毎回計算する）。
+        戻り値: (fall_count, total_merged_numbers, 最終盤面 (bytes))。
+        trace=True の場合は経過 {'initial': 初期盤面, 'action': action,
+        'falls': [{'board': 合成・落下後の盤面, 'merges': merge_clusters の events のタプル}, ...]} を4番目に加える。
+        """
+        if trace or not suppress_output:
+            return self._simulate_chain(action, max_value, suppress_output, incremental, trace)
+        key = (self.board, action, max_value)
+        cls = MergeGameSimulator
+        with cls._cache_lock:
+            result = cls._cache.get(key)
+            if result is not None:
+                cls._cache.move_to_end(key)
+                cls.cache_hits += 1
+                return result
+            cls.cache_misses += 1
+        result = self._simulate_chain(action, max_value, suppress_output, incremental)
+        with cls._cache_lock:
+            cls._cache[key] = result
+            while len(cls._cache) > cls.CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return result
+
+    def _simulate_chain(self, action, max_value, suppress_output, incremental, trace=False):
+        """simulate の本体（キャッシュを介さずに連鎖を計算する）"""
+        check_max_value(max_value)
+        board = bytearray(self.board)
+        falls = [] if trace or not suppress_output else None
+        i = action[1] * BOARD_SIZE + action[2]
+        if action[0] == "add":
+            if board[i]:
+                board[i] += 1
+        elif action[0] == "remove":
+            board[i] = 0
+        fall_count = 0
+        total_merged_numbers = 0
+        dirty = None  # 初回は盤面全体を走査する
+        self.apply_gravity(board)
+        while True:
+            clusters = self.find_clusters(board, dirty)
+            if not clusters:
+                break
+            events = None if falls is None else []
+            total_merged_numbers += self.merge_and_settle(board, clusters, fall_count, user_action=action,
+                                                          max_value=max_value, events=events)
+            if incremental:
+                dirty = self.dirty_cells(clusters, fall_count, user_action=action)
+            fall_count += 1
+            if falls is not None:
+                falls.append({'board': bytes(board), 'merges': tuple(events)})
+        result = (fall_count, total_merged_numbers, bytes(board))
+        if falls is None:
+            return result
+        record = {'initial': self.board, 'action': action, 'falls': falls}
+        if not suppress_output:
+            self.display_trace(record)
+        return result + (record,) if trace else result
+
+    def candidate_actions(self):
+        """空でないセルに対する "add" / "remove" を行優先の列挙順で返す（探索の同点判定はこの順序に従う）"""
+        return candidate_actions(self.board)
+
+    def evaluate_candidates(self, max_value=20):
+        """
+        盤面全体に対して "add" と "remove" を1回ずつ試行し、1手候補の一覧を返す。
+        各要素は辞書 {'action': (op, r, c), 'merged': 合成セル数, 'fall': 落下回数, 'board': 最終盤面}。
+        find_best_action / find_best_action_by_fall / find_best_action_multistep に渡すと再計算を省ける。
+        vectorized=True の場合は全候補を NumPy で一括シミュレーションする。
+        """
+        actions = self.candidate_actions()
+        if self.vectorized:
+            from batch_simulator import simulate_many
+            results = simulate_many([self.board] * len(actions), actions, max_value)
+        else:
+            results = [self.simulate(action, max_value=max_value, suppress_output=True) for action in actions]
+        candidates = []
+        for action, (fall, merged, board_after) in zip(actions, results):
+            candidates.append({
+                'action': action,
+                'merged': merged,
+                'fall': fall,
+                'board': board_after
+            })
+        return candidates
+
+    def find_best_action(self, max_value=20, candidates=None):
+        """
+        盤面全体に対して "add" と "remove" を試行し、
+        1手のみのシミュレーションで最適な操作（合成セル数優先）を求める。
+        candidates に evaluate_candidates の結果を渡した場合はそれを使う。
+        戻り値は辞書 {'action': (op, r, c), 'merged': 合成セル数, 'fall': 落下回数, 'board': 最終盤面}
+        （盤面に数字がなく候補がない場合は None）。
+        """
+        if candidates is None:
+            candidates = self.evaluate_candidates(max_value)
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda x: x['merged'])
+        return best
+
+    def find_best_action_by_fall(self, max_value=20, candidates=None):
+        """
+        盤面全体に対して "add" と "remove" を試行し、
+        1手のみのシミュレーションで最適な操作（落下回数優先）を求める。
+        candidates に evaluate_candidates の結果を渡した場合はそれを使う。
+        戻り値は find_best_action と同じ形式の辞書（候補がない場合は None）。
+        """
+        if candidates is None:
+            candidates = self.evaluate_candidates(max_value)
+        if not candidates:
+            return None
+        best = max(candidates, key=lambda x: x['fall'])
+        return best
+
+    def search(self, depth=2, max_value=20, candidates=None, parallel=False, time_limit=None):
+        """
+        最大 depth 手（1〜MAX_SEARCH_DEPTH）の操作列を探索し、合計合成セル数が最大となる手順を求める。
+        分枝限定法で、残り手数の合成セル数の上限（merge_upper_bound）を足しても
+        現在の最良手順に勝てない局面はそれ以上展開しない。
+        同点の場合は手数の少ない手順、さらに同じなら列挙順（candidate_actions）で先の手順を選ぶ。
+        結果盤面が同じになる手は、兄弟間でも探索全体でも1つだけ展開する。
+        探索中の局面は重複をすでに省いているので、simulate のキャッシュを通さずに _simulate_chain で計算する
+        （キャッシュには画面の再実行で使い回す1手候補を残す）。
+        1手目の候補には candidates（evaluate_candidates の結果）があればそれを使う。
+        parallel=True の場合は 1手目ごとの部分木を get_search_pool() のワーカーで探索する（結果は同じ）。
+        time_limit（秒）を指定すると、並列探索でも各部分木をその時点で打ち切り、それまでの最良手順を返す。
+        戻り値は辞書 {'actions': 操作のタプル, 'merged': 合計合成セル数, 'board': 最終盤面,
+                      'nodes': シミュレーションした局面数, 'pruned': 枝刈りした局面数,
+                      'duplicates': 結果盤面の重複で展開を省いた局面数,
+                      'complete': time_limit で打ち切られずに探索を終えたか}。
+        盤面に数字がなく候補がない場合は、手順が空（'actions' が ()、'merged' が 0）の辞書を返す。
+        """
+        if not 1 <= depth <= MAX_SEARCH_DEPTH:
+            raise ValueError(f"depth は 1〜{MAX_SEARCH_DEPTH} で指定してください: {depth}")
+        if candidates is None:
+            candidates = self.evaluate_candidates(max_value)
+        if not candidates:
+            return {'actions': (), 'merged': 0, 'board': self.board, 'nodes': 0, 'pruned': 0, 'duplicates': 0,
+                    'complete': True}
+        first = max(candidates, key=lambda x: x['merged'])
+        best = {'actions': (first['action'],), 'merged': first['merged'], 'board': first['board'],
+                'nodes': len(candidates), 'pruned': 0, 'duplicates': 0, 'complete': True}
+        if depth > 1:
+            children = [((cand['action'],), cand['merged'], cand['board']) for cand in candidates]
+            if parallel:
+                # ワーカーとは perf_counter の基準が共有されないので、期限は時刻（time.time）で渡す
+                deadline = None if time_limit is None else time.time() + time_limit
+                self._expand_parallel(children, depth - 1, max_value, best, deadline)
+            else:
+                budget = (None if time_limit is None else time.perf_counter() + time_limit, None)
+                try:
+                    self._expand(children, depth - 1, max_value, best, {}, budget)
+                except SearchBudgetExceeded:
+                    best['complete'] = False
+        return best
+
+    def _expand_parallel(self, children, remaining, max_value, best, deadline=None):
+        """
+        _expand の並列版。1手目の結果盤面ごとに search_subtree をワーカーで実行し、
+        各部分木の最良手順を 1手目の列挙順に _search_children と同じ規則でまとめる。
+        展開済み盤面の表は部分木ごとになるため、探索局面数は直列より増えることがある。
+        deadline（time.time の値）を過ぎると、各ワーカーは部分木の探索を打ち切って途中の最良手順を返す
+        （待ち行列に残っていた部分木はすぐに返る）。
+        """
+        distinct = distinct_results(children)
+        best['duplicates'] += len(children) - len(distinct)
+        initial = (best['actions'], best['merged'], best['board'])
+        tasks = [(board_after, sequence, total, remaining, max_value, initial, deadline)
+                 for sequence, total, board_after in distinct]
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            results = list(get_search_pool().map(search_subtree, tasks))
+        except BrokenProcessPool:
+            shutdown_search_pool()
+            raise
+        for result in results:
+            for key in ('nodes', 'pruned', 'duplicates'):
+                best[key] += result[key]
+            best['complete'] = best['complete'] and result['complete']
+            if result['merged'] > best['merged'] or (
+                    result['merged'] == best['merged'] and len(result['actions']) < len(best['actions'])):
+                best.update(actions=result['actions'], merged=result['merged'], board=result['board'])
+
+    def _expand(self, children, remaining, max_value, best, expanded, budget=(None, None)):
+        """結果盤面が同じ子局面は1つだけ展開する（distinct_results を参照）"""
+        distinct = distinct_results(children)
+        best['duplicates'] += len(children) - len(distinct)
+        for sequence, total, board_after in distinct:
+            self._search_children(board_after, sequence, total, remaining, max_value, best, expanded, budget)
+
+    def _search_children(self, board, actions, merged, remaining, max_value, best, expanded, budget=(None, None)):
+        """
+        search の再帰部分。board から残り remaining 手を展開し、best を更新する。
+        expanded は展開済みの盤面 -> (合計合成セル数, 手数)。同じ盤面をより少ない手数で、
+        同じ以上の合成セル数で展開済みなら、ここから先の手順はそちらに勝てないので省く。
+        budget は _deepen_children と同じ (期限の perf_counter 値, 局面数の上限)。超えたら SearchBudgetExceeded を送出する。
+        """
+        seen = expanded.get(board)
+        if seen is not None and seen[0] >= merged and seen[1] <= len(actions):
+            best['duplicates'] += 1
+            return
+        expanded[board] = (merged, len(actions))
+        bound = merged + merge_upper_bound(board, remaining, max_value)
+        if bound < best['merged'] or (bound == best['merged'] and len(actions) >= len(best['actions']) - 1):
+            best['pruned'] += 1
+            return
+        deadline, node_limit = budget
+        if (deadline is not None and time.perf_counter() >= deadline) or (
+                node_limit is not None and best['nodes'] >= node_limit):
+            raise SearchBudgetExceeded()
+        sim = MergeGameSimulator(board)
+        children = []
+        for action in sim.candidate_actions():
+            _, merged_next, board_after = sim._simulate_chain(action, max_value, True, True)
+            total = merged + merged_next
+            sequence = actions + (action,)
+            if total > best['merged'] or (total == best['merged'] and len(sequence) < len(best['actions'])):
+                best.update(actions=sequence, merged=total, board=board_after)
+            children.append((sequence, total, board_after))
+        best['nodes'] += len(children)
+        if remaining > 1:
+            self._expand(children, remaining - 1, max_value, best, expanded, budget)
+
+    def search_deepening(self, max_depth=MAX_SEARCH_DEPTH, max_value=20, candidates=None,
+                         time_limit=None, node_limit=None):
+        """
+        反復深化で 2手、3手、…、max_depth 手と探索し、上限に達したらそれまでの最良手順を返す。
+        time_limit（秒）と node_limit（シミュレーションした局面数）のどちらかに達した時点で打ち切る。
+        各深さでは、前の深さで部分木ごとに見つかった最大の合計合成セル数が大きい1手目から探索し、
+        前の深さの最良手順を初期値にするので、早い段階から枝刈りが効く。
+        手順の比較は improves（合成セル数、手数、列挙順）で行うため、探索順序によらず、
+        打ち切られなければ search(max_depth) と同じ手順を返す。
+        戻り値は search の戻り値に 'depth'（探索を終えた最大の手数）と
+        'complete'（max_depth まで探索を終えたか）を加えた辞書。
+        """
+        for step in self.search_deepening_steps(max_depth, max_value, candidates, time_limit, node_limit):
+            pass
+        del step['progress']
+        return step
+
+    def search_deepening_steps(self, max_depth=MAX_SEARCH_DEPTH, max_value=20, candidates=None,
+                               time_limit=None, node_limit=None):
+        """
+        search_deepening の逐次版。最初に1手のみの最良を、その後は1手目の部分木を1つ探索するごとに、
+        その時点の最良手順を yield する（最後に yield するものが search_deepening の戻り値）。
+        yield する辞書は search_deepening の戻り値に 'progress'（max_depth までの探索のうち終えた割合）を加えたもの。
+        上限は局面ごとに確かめるので、time_limit を過ぎると探索中の部分木の途中でも打ち切る。
+        """
+        if not 1 <= max_depth <= MAX_SEARCH_DEPTH:
+            raise ValueError(f"max_depth は 1〜{MAX_SEARCH_DEPTH} で指定してください: {max_depth}")
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        budget = (deadline, node_limit)
+        if candidates is None:
+            candidates = self.evaluate_candidates(max_value)
+        if not candidates:
+            yield dict(self.search(1, max_value, candidates), depth=max_depth, complete=True, progress=1.0)
+            return
+        first = max(candidates, key=lambda x: x['merged'])
+        best = {'actions': (first['action'],), 'merged': first['merged'], 'board': first['board'],
+                'nodes': len(candidates), 'pruned': 0, 'duplicates': 0, 'depth': 1, 'complete': max_depth == 1}
+        if max_depth == 1:
+            yield dict(best, progress=1.0)
+            return
+        roots = distinct_results([((cand['action'],), cand['merged'], cand['board']) for cand in candidates])
+        best['duplicates'] += len(candidates) - len(roots)
+        scores = [total for _, total, _ in roots]
+        progress = 0.0
+        yield dict(best, progress=progress)
+        try:
+            for depth in range(2, max_depth + 1):
+                expanded = {}
+                for n, k in enumerate(sorted(range(len(roots)), key=lambda k: -scores[k]), 1):
+                    sequence, total, board_after = roots[k]
+                    scores[k] = self._deepen_children(board_after, sequence, total, depth - 1, max_value,
+                                                      best, expanded, budget)
+                    progress = (depth - 2 + n / len(roots)) / (max_depth - 1)
+                    if n < len(roots):
+                        yield dict(best, progress=progress)
+                best['depth'] = depth
+                if depth < max_depth:
+                    yield dict(best, progress=progress)
+            best['complete'] = True
+        except SearchBudgetExceeded:
+            pass
+        yield dict(best, progress=progress)
+
+    def _deepen_children(self, board, actions, merged, remaining, max_value, best, expanded, budget):
+        """
+        search_deepening_steps の再帰部分（_search_children と同じ枝刈り・重複の省略を、
+        探索順序によらない improves の順序で行う）。部分木で見つかった最大の合計合成セル数を返す。
+        budget = (期限の perf_counter 値, 局面数の上限)。超えたら SearchBudgetExceeded を送出する。
+        """
+        key = sequence_key(actions)
+        seen = expanded.get(board)
+        if seen is not None and seen[1] <= len(actions) and (
+                seen[0] > merged or (seen[0] == merged and (seen[1] < len(actions) or seen[2] <= key))):
+            best['duplicates'] += 1
+            return merged
+        expanded[board] = (merged, len(actions), key)
+        bound = merged + merge_upper_bound(board, remaining, max_value)
+        if bound < best['merged'] or (bound == best['merged'] and (
+                len(actions) + 1 > len(best['actions'])
+                or (len(actions) + 1 == len(best['actions']) and key > sequence_key(best['actions'])[:len(actions)]))):
+            best['pruned'] += 1
+            return merged
+        deadline, node_limit = budget
+        if (deadline is not None and time.perf_counter() >= deadline) or (
+                node_limit is not None and best['nodes'] >= node_limit):
+            raise SearchBudgetExceeded()
+        sim = MergeGameSimulator(board)
+        children = []
+        for action in sim.candidate_actions():
+            _, merged_next, board_after = sim._simulate_chain(action, max_value, True, True)
+            total = merged + merged_next
+            sequence = actions + (action,)
+            if improves(total, sequence, best):
+                best.update(actions=sequence, merged=total, board=board_after)
+            children.append((sequence, total, board_after))
+        best['nodes'] += len(children)
+        subtree_best = max([merged] + [total for _, total, _ in children])
+        if remaining > 1:
+            distinct = distinct_results(children)
+            best['duplicates'] += len(children) - len(distinct)
+            # 合成セル数の多い子から展開し、良い手順を早く見つけて枝刈りを効かせる
+            for sequence, total, board_after in sorted(distinct, key=lambda child: -child[1]):
+                subtree_best = max(subtree_best, self._deepen_children(
+                    board_after, sequence, total, remaining - 1, max_value, best, expanded, budget))
+        return subtree_best
+
+    def find_best_action_multistep(self, max_value=20, threshold=6, candidates=None, parallel=False,
+                                   max_depth=2, time_limit=None, node_limit=None, store=None):
+        """
+        max_depth 手（既定は2手）までの操作シーケンスを solve_steps で検証する方式。
+        time_limit（秒）・node_limit（局面数）を指定すると、その範囲で見つかった最良の手順を返す。
+        1手目の候補には candidates（evaluate_candidates の結果）があればそれを使う。
+        parallel=True の場合は search(max_depth, parallel=True, time_limit=time_limit) で並列に探索する。
+        store（result_store.ResultStore）を渡すと、保存済みの結果があれば探索せずにそれを使い、
+        上限で打ち切られずに探索を終えた結果は保存する。
+        threshold は互換性のために受け付けるが使用しない。
+        戻り値は辞書 {'one_move': 1手目候補（候補がなければ None）, 'two_moves': 2手シーケンス候補（あれば）,
+                      'sequence': search_deepening と同じ形式の結果}。
+        """
+        if candidates is None:
+            candidates = self.evaluate_candidates(max_value)
+        one_move = self.find_best_action(max_value, candidates)
+        for best in self.solve_steps(max_depth, max_value, candidates, time_limit, node_limit, parallel, store):
+            pass
+        del best['progress']
+        result = {'one_move': one_move, 'two_moves': None, 'sequence': best}
+        if len(best['actions']) == 2:
+            result['two_moves'] = {'actions': best['actions'], 'merged': best['merged']}
+        return result
+
+    def solve_steps(self, max_depth=2, max_value=20, candidates=None, time_limit=None, node_limit=None,
+                    parallel=False, store=None):
+        """
+        find_best_action_multistep の逐次版。search_deepening_steps と同じ形式の辞書を yield する
+        （最後に yield するものが結果）。
+        ・store に (盤面, max_value, max_depth) の保存済みの結果があれば、探索せずにそれだけを yield する。
+        ・time_limit・node_limit のどちらかがある場合は search_deepening_steps で探索し、途中経過も yield する。
+        ・上限がない場合と parallel=True の場合は search の結果だけを yield する（parallel=True では
+          time_limit で打ち切り、node_limit は使わない。打ち切られた場合の 'depth' は 1）。
+        上限で打ち切られずに探索を終えた結果（'complete' が True）は、最後の yield の後で store に保存する。
+        """
+        best = None if store is None else store.get(self.board, max_value, max_depth)
+        if best is not None:
+            yield dict(best, depth=max_depth, complete=True, progress=1.0)
+            return
+        if candidates is None:
+            candidates = self.evaluate_candidates(max_value)
+        if parallel or (time_limit is None and node_limit is None):
+            best = self.search(depth=max_depth, max_value=max_value, candidates=candidates, parallel=parallel,
+                               time_limit=time_limit)
+            best.update(depth=max_depth if best['complete'] else 1, progress=1.0)
+            yield best
+        else:
+            for best in self.search_deepening_steps(max_depth=max_depth, max_value=max_value, candidates=candidates,
+                                                    time_limit=time_limit, node_limit=node_limit):
+                yield best
+        if store is not None and best['complete']:
+            store.put(self.board, max_value, max_depth, best)
+
+# ----------------------------
+# 並列探索
+# ----------------------------
+# Streamlit の再実行やセッションをまたいで使い回すプロセスプール
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+def _init_search_worker():
+    """fork されたワーカーで、親プロセスの他スレッドが保持していたかもしれないキャッシュのロックを作り直す"""
+    MergeGameSimulator._cache_lock = threading.Lock()
+    MergeGameSimulator.cache_clear()
+
+def get_search_pool():
+    """
+    並列探索用の ProcessPoolExecutor（SEARCH_WORKERS プロセス）を返す。初回呼び出し時にだけ作成する。
+    Streamlit はスクリプトを __main__ として実行するため、spawn 方式だとワーカーがアプリ本体を
+    再実行してしまう。使える環境では fork 方式で起動する。
+    multiprocessing は import に時間がかかるため、並列探索を使うときにだけ読み込む。
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+            _search_pool = ProcessPoolExecutor(max_workers=SEARCH_WORKERS,
+                                               mp_context=multiprocessing.get_context(method),
+                                               initializer=_init_search_worker)
+        return _search_pool
+
+def shutdown_search_pool():
+    """プロセスプールを終了する（次の get_search_pool で作り直される）"""
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is not None:
+            _search_pool.shutdown(wait=False, cancel_futures=True)
+            _search_pool = None
+
+def search_subtree(task):
+    """
+    並列探索のワーカー処理。task = (盤面, 手順, 合計合成セル数, 残り手数, max_value, 初期最良手順, 期限)。
+    初期最良手順（1手のみの最良）を上回るものがあれば、その部分木の最良手順を返す。
+    期限（time.time の値、None なら無制限）を過ぎたら打ち切り、'complete' を False にして途中の最良手順を返す。
+    """
+    board, sequence, merged, remaining, max_value, (actions, best_merged, best_board), deadline = task
+    best = {'actions': actions, 'merged': best_merged, 'board': best_board,
+            'nodes': 0, 'pruned': 0, 'duplicates': 0, 'complete': True}
+    budget = (None if deadline is None else time.perf_counter() + (deadline - time.time()), None)
+    try:
+        MergeGameSimulator(board)._search_children(board, sequence, merged, remaining, max_value, best, {}, budget)
+    except SearchBudgetExceeded:
+        best['complete'] = False
+    return best